@@ -4,6 +4,7 @@ from icecube import dataio,dataclasses,icetray
 from icecube import gulliver, millipede
 from icecube.icetray import I3Units
 import sys
+import multiprocessing
 from I3Tray import *
 import glob
 from astropy import units as u
@@ -31,30 +32,58 @@ def pos_uncertainty(skymap,min_pix,err,nside):
     max_th = diff_th.max()
     return np.degrees(min_ph),np.degrees(max_ph),np.degrees(min_th),np.degrees(max_th) 
 
-def load_frames(infile):
-    frame_packet = []
+class NsideResults(object):
+    """Pixel numbers and LLHs of one nside, in arrays preallocated for the full sky"""
+    def __init__(self,nside):
+        self.pix = np.empty(hp.nside2npix(nside))
+        self.llh = np.empty(hp.nside2npix(nside))
+        self.n = 0
+
+    def add(self,pix,llh):
+        if self.n == len(self.pix):
+            # more frames than pixels, so some pixels are repeated
+            self.pix = np.resize(self.pix,2*self.n)
+            self.llh = np.resize(self.llh,2*self.n)
+        self.pix[self.n] = pix
+        self.llh[self.n] = llh
+        self.n += 1
+
+    def map_info(self):
+        names = ['pix','llh','energy']
+        info = np.empty(self.n,[(n,float) for n in names])
+        info['pix'] = self.pix[:self.n]
+        info['llh'] = self.llh[:self.n]
+        return info
+
+def read_scan(infile):
+    """
+    Read the scan results in one pass over the file, keeping only the
+    event information and the pixel and LLH of each frame, by nside.
+    """
+    event = None
+    results = {}
     i3f = dataio.I3File(infile)
-    while True:
-       if not i3f.more():
-          return frame_packet
-       frame = i3f.pop_frame()
-       frame_packet.append(frame)
-
-def extract_results(fpacket,nside):
-    names = ['pix','llh','energy']
-    p_results = []
-
-    for f in frame_packet:
-      if "MillipedeStarting2ndPass_millipedellh" in f:
-        if f["SCAN_HealpixNSide"].value == nside:
-           fr_info = np.empty(1,[(n,float) for n in names])
-           fr_info['pix'] = f["SCAN_HealpixPixel"].value
-           fr_info['llh'] = f["MillipedeStarting2ndPass_millipedellh"].logl
-#           fr_info['energy'] = f["MillipedeStarting2ndPass_totalRecoLossesTotal"].value
-	   
-           p_results.append(fr_info)
-    
-    return np.concatenate(p_results)
+    while i3f.more():
+       f = i3f.pop_frame()
+       if f.Stop != icetray.I3Frame.Physics:
+          continue
+       #Extract event header info from the first Physics frame
+       if event is None and "CNN_classification" in f:
+          event = {'event_id': f["I3EventHeader"].event_id,
+                   'run_id': f["I3EventHeader"].run_id,
+                   'start_time': f["I3EventHeader"].start_time,
+                   'cnn': f["CNN_classification"],
+                   'gfu': f["AlertInfoGFU"],
+                   'hese': f["AlertInfoHESE"],
+                   'alert_pass': f["AlertPassed"].value}
+       nside = f["SCAN_HealpixNSide"].value
+       if nside not in results:
+          results[nside] = NsideResults(nside)
+       if "MillipedeStarting2ndPass_millipedellh" in f:
+          results[nside].add(f["SCAN_HealpixPixel"].value,
+                             f["MillipedeStarting2ndPass_millipedellh"].logl)
+    i3f.close()
+    return event, results
 
 def fixpixnumber(nside,map_array):
     o_pix = map_array['pix'].astype(int)
@@ -66,27 +95,16 @@ def fixpixnumber(nside,map_array):
 
 
 
-parser = argparse.ArgumentParser(description = "Read i3 output of a scan and convert to fits format")
-parser.add_argument('-i', '--input', nargs = '+',dest = 'input',help = 'path to input file with scan results')
-parser.add_argument('-o', '--output', dest = 'output',help = 'Prefix for output fits files')
-args = parser.parse_args()
-
-for pf in args.input:
-
+def convert(pf,output):
     print(pf)
-    frame_packet = load_frames(pf)
-    
-    #Extract event header info from the first Physics frame
-    for f in frame_packet:
-        if f.Stop == icetray.I3Frame.Physics and "CNN_classification" in f:
-           event_id = f["I3EventHeader"].event_id
-           run_id = f["I3EventHeader"].run_id
-           start_time = f["I3EventHeader"].start_time
-           cnn = f["CNN_classification"]
-           gfu = f["AlertInfoGFU"]
-           hese = f["AlertInfoHESE"]
-           alert_pass = f["AlertPassed"].value
-           break
+    event, results = read_scan(pf)
+    event_id = event['event_id']
+    run_id = event['run_id']
+    start_time = event['start_time']
+    cnn = event['cnn']
+    gfu = event['gfu']
+    hese = event['hese']
+    alert_pass = event['alert_pass']
 
     cnn_vals = [float("%0.2e"%x) for x in cnn.values()]
     
@@ -109,19 +127,12 @@ for pf in args.input:
            far = gfu['yearly_rate']
            nu_energy = gfu['E_nu_peak']
     print(alert_type)
-    #Find nside from the Physics frame
-    ns_array = []
-    for f in frame_packet:
-        if f.Stop == icetray.I3Frame.Physics:
-           nside = f["SCAN_HealpixNSide"].value
-           ns_array.append(nside)
-    #Extract pixel by pixel info
-    Nsides = sorted(np.unique(ns_array))
+    #Pixel by pixel info, by nside
+    Nsides = sorted(results)
     print(Nsides)
     skymap = None
     for nside in Nsides:
-      map_info = extract_results(frame_packet,nside)
-      
+      map_info = results[nside].map_info()
       #Write skymap
       npix = hp.nside2npix(nside)
       if skymap is not None:
@@ -189,7 +200,7 @@ for pf in args.input:
      
       
     #Save file
-    hp.write_map("%sRun%s_%s_nside%s.fits.gz"%(args.output,run_id,event_id,nside),
+    hp.write_map("%sRun%s_%s_nside%s.fits.gz"%(output,run_id,event_id,nside),
         #skymap,coord = 'C',column_names = ['2LLH'],extra_header = header,overwrite = True)
         skymap,coord = 'C',column_names = ['2LLH'],extra_header = header)
     
@@ -199,6 +210,33 @@ for pf in args.input:
 #    w = open(ofile,'a')
 #    w.write("%s\t%s\t%0.2f\t%0.2f\t%0.2f\t%0.2f\t%0.2f\t%0.2f\t%0.2f\t %s\t%s\n"%(run_id,event_id,ra,dec,uncertainty[0],uncertainty[1],uncertainty[2],uncertainty[3],deposited_e[0],signalness,far))
 #    w.close()
+    return run_id,ra,dec,min_pix
+
+def _convert(job):
+    return job[0], convert(*job)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Read i3 output of a scan and convert to fits format")
+    parser.add_argument('-i', '--input', nargs = '+',dest = 'input',help = 'path to input file with scan results')
+    parser.add_argument('-o', '--output', dest = 'output',help = 'Prefix for output fits files')
+    parser.add_argument('-n', '--procs', type = int, default = 1, help = 'input files converted in parallel')
+    args = parser.parse_args()
+
+    jobs = [(pf,args.output) for pf in args.input]
+    if args.procs > 1 and len(jobs) > 1:
+       pool = multiprocessing.Pool(min(args.procs,len(jobs)))
+       results = pool.map(_convert,jobs)
+       pool.close()
+       pool.join()
+    else:
+       results = [_convert(job) for job in jobs]
+    for pf,summary in results:
+       print("%s %s %s %s %s"%((pf,)+tuple(summary)))
+
+    print("Done")
+
+if __name__ == '__main__':
+    main()
 
 
 #Alternate Using Astropy tables
@@ -217,9 +255,3 @@ for pf in args.input:
 #hdu_list = fits.HDUList([empty_primary,
 #			table_hdu])
 #hdu_list.writeto('Test_scan2.fits.gz')
-
-print("Done")
-
-
-
-
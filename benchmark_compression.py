@@ -0,0 +1,44 @@
+from __future__ import print_function
+import argparse
+import time
+
+from icecube import dataio
+
+import compression
+import envelope
+
+def load_frames(infile):
+    frame_packet = []
+    i3f = dataio.I3File(infile)
+    while i3f.more():
+        frame_packet.append(i3f.pop_frame())
+    return frame_packet
+
+def timeit(func, data, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        out = func(data)
+    return out, (time.time()-start)/repeat
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare message compression codecs on a frame packet')
+    parser.add_argument('infile', nargs='?', default='run00127907.evt000020178442.HESE_GCDQP.i3',
+                        help='input GCDQp i3 file')
+    parser.add_argument('-n', '--repeat', type=int, default=10, help='repetitions per codec')
+    args = parser.parse_args()
+
+    data = envelope.encode(load_frames(args.infile))
+    mb = len(data)/1e6
+    print('message size: {:.2f} MB'.format(mb))
+    print('{:>8} {:>8} {:>14} {:>14}'.format('codec', 'ratio', 'encode MB/s', 'decode MB/s'))
+    for name in compression.available():
+        compress, decompress = compression.CODECS[name]
+        body, t_enc = timeit(compress, data, args.repeat)
+        out, t_dec = timeit(decompress, body, args.repeat)
+        if out != data:
+            raise Exception('codec {} does not round trip'.format(name))
+        print('{:>8} {:>8.2f} {:>14.1f} {:>14.1f}'.format(
+              name, float(len(data))/len(body), mb/t_enc, mb/t_dec))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+from __future__ import print_function
+import argparse
+import threading
+import time
+
+from icecube import icetray
+
+from memory_queue import MemoryBroker, MemorySourceQueue, MemorySinkQueue
+from util import Source, Sink
+from benchmark_compression import load_frames
+import compression
+from producer_new import send_pixels, parse_batch_sizes
+
+def pixel_key(frame):
+    return (frame['SCAN_HealpixNSide'].value, frame['SCAN_HealpixPixel'].value,
+            frame['SCAN_PositionVariationIndex'].value)
+
+class TimedSource(Source):
+    """Source that notes when each P-frame went out, and the time spent sending"""
+    def __init__(self, queue, sent_times=None):
+        Source.__init__(self, queue)
+        self.sent_times = sent_times
+        self.messages = 0
+        self.send_time = 0.
+    def send(self, frames, packet_hash=None):
+        start = time.time()
+        if self.sent_times is not None:
+            for fr in frames:
+                if fr.Stop == icetray.I3Frame.Physics:
+                    self.sent_times[pixel_key(fr)] = start
+        Source.send(self, frames, packet_hash)
+        self.messages += 1
+        self.send_time += time.time()-start
+
+class Stats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.messages = 0
+        self.decode_time = 0.
+        self.last_time = None
+    def add_message(self, decode_time):
+        with self.lock:
+            self.messages += 1
+            self.decode_time += decode_time or 0.
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values)-1, int(q*len(values)))]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the producer -> worker -> consumer message path on an in-memory broker')
+    parser.add_argument('infile', nargs='?', default='run00127907.evt000020178442.HESE_GCDQP.i3',
+                        help='input GCDQp i3 file')
+    parser.add_argument('--nside', type=int, default=4, help='healpix nside of the scan')
+    parser.add_argument('--batch', nargs='+', default=['1'],
+                        help='P-frames per message, as "size" or per nside as "nside:size"')
+    parser.add_argument('--packet-once', dest='packet_once', action='store_true',
+                        help='send the GCDQ packet once and reference it by hash')
+    parser.add_argument('--compression', default=None, choices=compression.available(),
+                        help='compression codec for sent messages')
+    parser.add_argument('--consumers', type=int, default=1, help='consumer threads')
+    parser.add_argument('--fit-time', dest='fit_time', type=float, default=0.,
+                        help='seconds the stub reconstruction takes per pixel')
+    parser.add_argument('--timeout', type=float, default=2., help='idle seconds before a stage stops')
+    args = parser.parse_args()
+
+    fpacket = load_frames(args.infile)
+    broker = MemoryBroker()
+    sent_times = {}
+    stats = Stats()
+
+    def worker():
+        with MemorySinkQueue(queue='inqueue', timeout=args.timeout, broker=broker) as in_queue:
+            with MemorySourceQueue(queue='outqueue', compression=args.compression, broker=broker) as out_queue:
+                source = TimedSource(out_queue)
+                def cb(frames):
+                    stats.add_message(sink.decode_time())
+                    source.forward(frames, sink.packet_hash())
+                sink = Sink(in_queue, cb)
+                in_queue.start_recv()
+        worker_stats['send_time'] = source.send_time
+        worker_stats['messages'] = source.messages
+
+    def consumer():
+        with MemorySinkQueue(queue='outqueue', timeout=args.timeout, broker=broker) as queue:
+            def cb(frames):
+                stats.add_message(sink.decode_time())
+                for fr in frames:
+                    if fr.Stop != icetray.I3Frame.Physics:
+                        continue
+                    # stub reconstruction
+                    time.sleep(args.fit_time)
+                    now = time.time()
+                    with stats.lock:
+                        stats.latencies.append(now-sent_times[pixel_key(fr)])
+                        stats.last_time = now
+            sink = Sink(queue, cb)
+            queue.start_recv()
+
+    worker_stats = {}
+    threads = [threading.Thread(target=worker)]
+    threads += [threading.Thread(target=consumer) for _ in range(args.consumers)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    with MemorySourceQueue(queue='inqueue', compression=args.compression, broker=broker) as queue:
+        source = TimedSource(queue, sent_times)
+        send_pixels(source, fpacket, args.nside, packet_once=args.packet_once,
+                    batch_size=parse_batch_sizes(args.batch))
+    produce_time = time.time()-start
+    for t in threads:
+        t.join()
+
+    npixels = len(stats.latencies)
+    if not npixels:
+        print('no pixels made it through')
+        return
+    wall = stats.last_time-start
+    nsent = source.messages+worker_stats['messages']
+    print('pixels: {}, messages: {} produced, {} received'.format(npixels, source.messages, stats.messages))
+    print('producer: {:.2f} s'.format(produce_time))
+    print('throughput: {:.1f} pixels/s'.format(npixels/wall))
+    print('serialization: encode+send {:.2f} ms/msg, decode {:.2f} ms/msg'.format(
+          1000.*(source.send_time+worker_stats['send_time'])/nsent,
+          1000.*stats.decode_time/stats.messages))
+    print('latency: p50 {:.3f} s, p90 {:.3f} s, p99 {:.3f} s, max {:.3f} s'.format(
+          percentile(stats.latencies, 0.5), percentile(stats.latencies, 0.9),
+          percentile(stats.latencies, 0.99), max(stats.latencies)))
+
+if __name__ == '__main__':
+    main()
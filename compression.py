@@ -0,0 +1,47 @@
+"""
+Compression codecs for message bodies.
+
+The codec name goes in the AMQP `content_encoding` property, so receivers
+can decompress without being told which codec the sender picked.
+"""
+import zlib
+
+CODECS = {}
+
+def register(name, compress, decompress):
+    CODECS[name] = (compress, decompress)
+
+register('zlib', lambda data: zlib.compress(data, 1), zlib.decompress)
+
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:
+    register('lz4', lz4.frame.compress, lz4.frame.decompress)
+
+try:
+    import zstandard
+except ImportError:
+    pass
+else:
+    # compressor objects are not thread safe, so make one per message
+    register('zstd', lambda data: zstandard.ZstdCompressor(level=1).compress(data),
+             lambda data: zstandard.ZstdDecompressor().decompress(data))
+
+def available():
+    return sorted(CODECS)
+
+def compress(name, data):
+    if not name:
+        return data
+    if name not in CODECS:
+        raise Exception('unknown compression codec {}'.format(name))
+    return CODECS[name][0](data)
+
+def decompress(name, data):
+    if not name or name == 'identity':
+        return data
+    if name not in CODECS:
+        raise Exception('unknown compression codec {}'.format(name))
+    return CODECS[name][1](data)
@@ -0,0 +1,200 @@
+from __future__ import print_function
+import os
+import sys
+import time
+import logging
+import traceback
+
+from icecube import icetray, dataio
+from I3Tray import I3Tray
+
+from util import SinkQueue, Sink, SourceQueue, Source, DataError, get_parser
+sys.path.append('scan')
+from consolidate_scan import FindBestRecoResultForPixel, pixel_key, give_up_frame
+
+# seconds to wait for a message before checking for stalled pixels
+POLL_TIME = 10
+
+class ResultReader(icetray.I3Module):
+    """
+    Driving module that pulls result messages from a SinkQueue.
+
+    A message is only acked once the best frame of every pixel in it has
+    been written, so the results of unfinished pixels come back if this
+    process dies. A pixel without a new result for `pixel_timeout`
+    seconds, such as one with a dead-lettered position variation, is
+    given up on: its best frame so far is written and its messages acked.
+    Results for pixels already written are acked and dropped, until their
+    event has been idle for `event_expiry` seconds. Stops once the queue
+    has been idle for its timeout with no pixel in progress.
+    """
+    def __init__(self, context):
+        icetray.I3Module.__init__(self, context)
+        self.AddParameter('queue', 'input SinkQueue', None)
+        self.AddParameter('sink', 'Sink to decode the messages', None)
+        self.AddParameter('written', 'list of the pixels written since the last message', None)
+        self.AddParameter('pixel_timeout', 'seconds without results before giving up on a pixel', 600)
+        self.AddParameter('event_expiry', 'seconds an idle event\'s written pixels are remembered', 3600)
+    def Configure(self):
+        self.queue = self.GetParameter('queue')
+        self.sink = self.GetParameter('sink')
+        self.written = self.GetParameter('written')
+        self.pixel_timeout = self.GetParameter('pixel_timeout')
+        self.event_expiry = self.GetParameter('event_expiry')
+        self.pixel_tags = {} # pixel -> delivery tags of its messages
+        self.pixel_times = {} # pixel -> time of its last result
+        self.tag_pixels = {} # delivery tag -> number of its pixels not yet written
+        self.done = {} # (run_id, event_id) -> pixels written
+        self.event_times = {} # (run_id, event_id) -> time of its last result
+        self.given_up = set()
+        self.last_time = time.time()
+    def Process(self):
+        self.ack_written()
+        self.expire()
+        msg = self.queue.receive(POLL_TIME)
+        if msg is None:
+            if not self.tag_pixels and time.time()-self.last_time > self.queue.timeout:
+                print('idle timeout hit')
+                self.RequestSuspension()
+            return
+        self.last_time = time.time()
+        delivery_tag, body, properties = msg
+        try:
+            frames = self.sink.decode(self.queue.decode_body(properties, body))
+        except DataError:
+            logging.warning('error with data', exc_info=True)
+            self.queue.dead_letter(delivery_tag, body, properties, traceback.format_exc())
+            return
+        pixels = set()
+        for fr in frames or []:
+            if fr.Stop == icetray.I3Frame.Physics:
+                key = pixel_key(fr)
+                self.event_times[key[:2]] = self.last_time
+                if key in self.given_up or key in self.done.get(key[:2], ()):
+                    print('pixel', key, 'already written, dropping a late result')
+                    continue
+                pixels.add(key)
+                self.pixel_times[key] = self.last_time
+            self.PushFrame(fr)
+        if not pixels:
+            self.queue.ack(delivery_tag)
+            return
+        self.tag_pixels[delivery_tag] = len(pixels)
+        for key in pixels:
+            self.pixel_tags.setdefault(key, []).append(delivery_tag)
+    def Finish(self):
+        self.ack_written()
+        if self.tag_pixels:
+            print('{} messages of unfinished pixels left unacked'.format(len(self.tag_pixels)))
+    def ack_written(self):
+        """Ack the messages whose pixels have all been written"""
+        while self.written:
+            self.release(self.written.pop(0))
+        # given up on last time, but without a frame to write
+        while self.given_up:
+            key = self.given_up.pop()
+            if key in self.pixel_tags:
+                print('pixel', key, 'had no frame to write, dropping its results')
+                self.release(key)
+    def release(self, key):
+        """Mark a pixel as done, acking the messages left with nothing to write"""
+        self.done.setdefault(key[:2], set()).add(key)
+        self.pixel_times.pop(key, None)
+        for tag in self.pixel_tags.pop(key, []):
+            self.tag_pixels[tag] -= 1
+            if self.tag_pixels[tag] == 0:
+                del self.tag_pixels[tag]
+                self.queue.ack(tag)
+    def expire(self):
+        """Give up on stalled pixels, and forget the pixels of idle events"""
+        now = time.time()
+        for key, last in list(self.pixel_times.items()):
+            if now-last > self.pixel_timeout:
+                print('no results for pixel', key, 'in', self.pixel_timeout, 's, giving up on it')
+                del self.pixel_times[key]
+                self.given_up.add(key)
+                self.PushFrame(give_up_frame(key))
+        idle = [event for event, last in self.event_times.items() if now-last > self.event_expiry]
+        if idle:
+            active = set(key[:2] for key in self.pixel_tags)
+            for event in idle:
+                if event not in active:
+                    del self.event_times[event]
+                    self.done.pop(event, None)
+
+class BestFrameWriter(icetray.I3Module):
+    """
+    Appends each best frame to the BestFit_Frames.i3 of its event, as
+    find_bestframe.py does, and optionally sends it on.
+    """
+    def __init__(self, context):
+        icetray.I3Module.__init__(self, context)
+        self.AddParameter('output_dir', 'directory with one sub-directory per event', None)
+        self.AddParameter('sender', 'also send each best frame with this function', None)
+        self.AddParameter('written', 'list to add the written pixels to', None)
+        self.AddOutBox("OutBox")
+    def Configure(self):
+        self.output_dir = self.GetParameter('output_dir')
+        self.sender = self.GetParameter('sender')
+        self.written = self.GetParameter('written')
+        self.npixels = 0
+    def Physics(self, frame):
+        event_dir = os.path.join(self.output_dir, str(frame['I3EventHeader'].event_id))
+        if not os.path.exists(event_dir):
+            os.makedirs(event_dir)
+        with dataio.I3File(os.path.join(event_dir, 'BestFit_Frames.i3'), 'a') as f:
+            f.push(frame)
+        if self.sender:
+            self.sender([frame])
+        if self.written is not None:
+            self.written.append(pixel_key(frame))
+        self.npixels += 1
+        self.PushFrame(frame)
+    def Finish(self):
+        print('consolidated {} pixels'.format(self.npixels))
+
+def consolidate(args, sender=None):
+    with SinkQueue(address=args.address, queue=args.queue, timeout=args.timeout,
+                   max_retries=args.max_retries, prefetch=args.prefetch,
+                   exchange=args.exchange) as in_queue:
+        sink = Sink(in_queue, None)
+        written = []
+        tray = I3Tray()
+        tray.Add(ResultReader, queue=in_queue, sink=sink, written=written,
+                 pixel_timeout=args.pixel_timeout, event_expiry=args.event_expiry)
+        tray.Add(FindBestRecoResultForPixel, "FindBestRecoResultForPixel", NPosVar=args.npos,
+                 RunningBest=True)
+        tray.Add(BestFrameWriter, output_dir=args.outpath, sender=sender, written=written)
+        tray.Execute()
+        tray.Finish()
+        del tray
+
+def main():
+    parser = get_parser()
+    parser.description = 'Keep the best frame of each pixel as results arrive on the results queue'
+    parser.add_argument('outpath', help='output directory, with a BestFit_Frames.i3 per event')
+    parser.add_argument('--npos', type=int, default=7, help='position variations per pixel')
+    parser.add_argument('-e', '--exchange', default=None,
+                        help='results exchange the consumers publish to, bound to the queue given with -q')
+    parser.add_argument('-o', '--out-queue', dest='out_queue', default=None,
+                        help='also send each best frame to this queue')
+    parser.add_argument('--prefetch', type=int, default=1000,
+                        help='unacked results held at once, must cover those of the pixels in progress')
+    parser.add_argument('--pixel-timeout', dest='pixel_timeout', type=int, default=600,
+                        help='seconds without results before writing the best frame so far of a pixel')
+    parser.add_argument('--event-expiry', dest='event_expiry', type=int, default=3600,
+                        help='seconds an idle event\'s written pixels are remembered, to drop late results')
+    parser.add_argument('--max-retries', dest='max_retries', type=int, default=3,
+                        help='retries for a failing message before it is dead-lettered')
+    args = parser.parse_args()
+
+    if args.out_queue:
+        with SourceQueue(args.address, args.out_queue, compression=args.compression) as out_queue:
+            source = Source(out_queue)
+            consolidate(args, source.send)
+    else:
+        consolidate(args)
+    print('done!')
+
+if __name__ == '__main__':
+    main()
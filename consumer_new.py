@@ -2,32 +2,236 @@ from __future__ import print_function
 import argparse
 from functools import partial
 import sys
+import threading
+import traceback
+import multiprocessing
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
 from icecube import icetray,dataio,dataclasses
 from I3Tray import I3Tray
 
-from util import SinkQueue, Sink, get_parser
+import envelope
+import metrics
+from util import SinkQueue, AsyncSinkQueue, Sink, SourceQueue, Source, get_parser
 sys.path.append('scan')
-from scan_pixel_distributed import scan_pixel_distributed_client
+from scan_pixel_distributed import PixelScanEngine
+from stage_timing import STAGE_TIMES, StageHistograms, add_stage_time
 
 def writer(outfile, frames):
     with dataio.I3File(outfile, 'a') as f:
         for fr in frames:
-	    print(fr.Stop)
+            print(fr.Stop)
             f.push(fr)
 
+try:
+    # the fit processes have to be forks to share the loaded tables, and
+    # the engine cannot be pickled for spawn or forkserver
+    fork_context = multiprocessing.get_context('fork')
+except AttributeError:
+    # python 2 always forks
+    fork_context = multiprocessing
+
+def fit_process(engine, conn):
+    """Run fits for frames arriving on a pipe, until the pipe closes"""
+    while True:
+        try:
+            data = conn.recv_bytes()
+        except EOFError:
+            break
+        try:
+            header = envelope.decode_header(data)
+            out_frames = engine(envelope.decode_frames(data, header), header.packet_hash)
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+        else:
+            conn.send(('ok', envelope.encode(out_frames)))
+    engine.close()
+
+class NoFitProcesses(Exception):
+    pass
+
+class FitPool(object):
+    """
+    Fit processes forked from this one.
+
+    The engine's spline tables are loaded before forking, so the fit
+    processes share those pages copy-on-write rather than each holding
+    its own copy. Frames go to an idle process over a pipe. All the forks
+    happen up front, before any threads start, so a process that dies is
+    dropped rather than replaced, and calls fail with NoFitProcesses once
+    none are left.
+    """
+    def __init__(self, engine, size=1):
+        self.engine = engine
+        self.idle = Queue.Queue()
+        self.procs = []
+        for _ in range(size):
+            self.idle.put(self.start_proc())
+
+    def start_proc(self):
+        conn, child_conn = fork_context.Pipe()
+        proc = fork_context.Process(target=fit_process, args=(self.engine, child_conn))
+        proc.daemon = True
+        proc.start()
+        child_conn.close()
+        proc.conn = conn
+        self.procs.append(proc)
+        return proc
+
+    def stop_proc(self, proc):
+        self.procs.remove(proc)
+        proc.conn.close()
+        if proc.is_alive():
+            proc.terminate()
+        proc.join()
+
+    def __call__(self, frames, packet_hash=None):
+        proc = self.idle.get()
+        if proc is None:
+            # wake up the next caller too
+            self.idle.put(None)
+            raise NoFitProcesses('all fit processes have exited')
+        try:
+            proc.conn.send_bytes(envelope.encode(frames, envelope.TYPE_DATA, packet_hash))
+            status, data = proc.conn.recv()
+        except (EOFError, IOError):
+            # a new fork would copy the connection and metrics threads'
+            # locks in whatever state they are in, so do without it
+            self.stop_proc(proc)
+            code = proc.exitcode
+            proc = None
+            if not self.procs:
+                # that was the last one, so fail this and every later call
+                self.idle.put(None)
+            raise Exception('fit process exited with code {}, {} left'.format(code, len(self.procs)))
+        finally:
+            if proc is not None:
+                self.idle.put(proc)
+        if status == 'error':
+            raise Exception(data)
+        return envelope.decode_frames(data)
+
+    def close(self):
+        for proc in list(self.procs):
+            proc.conn.close()
+            proc.join()
+            self.procs.remove(proc)
+
+def observe_fit(frame):
+    """Export the stage times of a reconstructed P-frame as metrics"""
+    if STAGE_TIMES not in frame:
+        return
+    times = frame[STAGE_TIMES]
+    for stage in times.keys():
+        metrics.STAGE_SECONDS.labels(stage).observe(times[stage])
+    fit = sum(times[stage] for stage in ("1st_pass", "2nd_pass") if stage in times)
+    metrics.FIT_SECONDS.labels(str(frame["SCAN_HealpixNSide"].value)).observe(fit)
+
+def consume(args, engine, results=None, timing=None):
+    """
+    Scan pixels from the queue, optionally publishing each result and
+    adding its stage times to the `timing` histograms.
+    """
+    lock = threading.Lock()
+    def cb(frames):
+        unpack_time = s.decode_time()
+        p_frames = [fr for fr in frames if fr.Stop == icetray.I3Frame.Physics]
+        if unpack_time is not None and p_frames:
+            # a share each, so the pixel times of a batch add up to the message's
+            for fr in p_frames:
+                add_stage_time(fr, "unpack", unpack_time/len(p_frames))
+        # a batch of pixels goes through the tray at once, and is acked once
+        try:
+            out_frames = engine(frames, s.packet_hash())
+        except NoFitProcesses:
+            # nothing left to run fits, so stop taking messages
+            queue.stop()
+            raise
+        for frame in out_frames:
+            with lock:
+                if timing is not None:
+                    timing.add_frame(frame)
+                observe_fit(frame)
+                if results:
+                    results.send([frame])
+    if args.procs:
+        # one connection feeding all the fit processes
+        in_queue = AsyncSinkQueue(address=args.address, queue=args.queue, timeout=args.timeout,
+                                  max_retries=args.max_retries,
+                                  prefetch=max(args.prefetch, args.procs+1), workers=args.procs)
+    elif args.async_recv:
+        # keep the next messages local and the connection alive during
+        # fits, which the engine runs one at a time
+        in_queue = AsyncSinkQueue(address=args.address, queue=args.queue, timeout=args.timeout,
+                                  max_retries=args.max_retries,
+                                  prefetch=args.prefetch, workers=1)
+    else:
+        in_queue = SinkQueue(address=args.address, queue=args.queue, timeout=args.timeout,
+                             max_retries=args.max_retries)
+    with in_queue as queue:
+        s = Sink(queue, callback=cb)
+        queue.start_recv()
+
 def main():
     parser = get_parser()
     parser.add_argument('outpath', help='output directory for results')
     parser.add_argument('-b','--baseline', default = 'baseline',help='direcotry with baseline GCD files')
+    parser.add_argument('-r', '--results-exchange', dest='results_exchange', default=None,
+                        help='also publish each reconstructed P-frame to this fanout exchange')
+    parser.add_argument('--event-cache-size', dest='event_cache_size', type=int, default=4,
+                        help='number of events whose uncompressed GCD and DOM exclusions are kept in memory')
+    parser.add_argument('--event-cache-dir', dest='event_cache_dir', default=None,
+                        help='also keep uncompressed GCD and DOM exclusions in this directory')
+    parser.add_argument('--max-retries', dest='max_retries', type=int, default=3,
+                        help='retries for a failing pixel before it is dead-lettered')
+    parser.add_argument('--async', dest='async_recv', action='store_true',
+                        help='run fits on a worker thread, with several messages in flight')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='messages held at once in --async mode')
+    parser.add_argument('--warm-seed', dest='warm_seed', action='store_true',
+                        help='seed the 1st pass from the warm seed the producer sends, where there is one')
+    parser.add_argument('--llh-gap', dest='llh_gap', type=float, default=None,
+                        help='skip the 2nd pass for pixels whose 1st pass LLH is this far above the best 1st pass LLH of the event')
+    parser.add_argument('--fit-timeout', dest='fit_timeout', type=int, default=3600,
+                        help='seconds to wait for each reconstructed pixel before failing its message')
+    parser.add_argument('--procs', type=int, default=0,
+                        help='fork this many fit processes sharing the spline tables')
     args = parser.parse_args()
    
     
     pulsesName="UncleanedInIcePulses"    
 #    pulsesName="SplitUncleanedInIcePulsesLatePulseCleaned"    
-    with SinkQueue(address=args.address, queue=args.queue, timeout=args.timeout) as queue:
-        s = Sink(queue, callback=partial(scan_pixel_distributed_client,pulsesName=pulsesName,
-	output=args.outpath,baseline=args.baseline))
-        queue.start_recv()
+    # load the spline tables and configure the fit once for all messages
+    engine = PixelScanEngine(pulsesName=pulsesName, output=args.outpath,
+                             baseline=args.baseline,
+                             event_cache_size=args.event_cache_size,
+                             event_cache_dir=args.event_cache_dir,
+                             warm_seed=args.warm_seed,
+                             llh_gap=args.llh_gap,
+                             fit_timeout=args.fit_timeout)
+    if args.procs:
+        # fork before connecting, so the children share the loaded tables
+        engine = FitPool(engine, args.procs)
+    # the metrics server runs on a thread, so only after forking
+    metrics.setup(args, 'consumer')
+    timing = StageHistograms()
+    try:
+        if args.results_exchange:
+            # every subscriber, such as the producer and a consolidator,
+            # gets each result on a queue of its own
+            with SourceQueue(args.address, args.results_exchange,
+                             compression=args.compression,
+                             exchange=args.results_exchange) as results_queue:
+                consume(args, engine, Source(results_queue), timing=timing)
+        else:
+            consume(args, engine, timing=timing)
+    finally:
+        engine.close()
+        if timing.counts:
+            print('stage times:')
+            print(timing.summary())
     print('done!')
 
 if __name__ == '__main__':
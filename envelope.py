@@ -0,0 +1,138 @@
+"""
+Binary message envelope for frames on the queues.
+
+A message is a fixed size header followed by the frames, each one as a
+length prefix and the output of `I3Frame.dumps()`::
+
+    magic, version, type, run id, event id, nside, pixel, position
+    variation, number of frames, packet hash
+    length, frame
+    length, frame
+    ...
+
+The header describes the first P-frame in the message, so receivers can
+route and filter messages without deserializing any frame.
+
+Over a stream, such as a pipe, each message goes with a length prefix.
+"""
+import struct
+from collections import namedtuple
+
+from icecube import icetray
+
+MAGIC = b'I3SM'
+VERSION = 1
+
+TYPE_DATA = 1
+TYPE_PACKET = 2
+
+_header = struct.Struct('!4sBBIIiqiI40s')
+_length = struct.Struct('!Q')
+
+Header = namedtuple('Header', ['type', 'run_id', 'event_id', 'nside', 'pixel',
+                               'posvar', 'nframes', 'packet_hash'])
+
+
+class EnvelopeError(Exception):
+    pass
+
+def is_envelope(data):
+    return data[:len(MAGIC)] == MAGIC
+
+def _int_value(frame, key):
+    if frame is not None and key in frame:
+        return frame[key].value
+    return -1
+
+def make_header(frames, msg_type=TYPE_DATA, packet_hash=None):
+    p_frame = None
+    for fr in frames:
+        if fr.Stop == icetray.I3Frame.Physics:
+            p_frame = fr
+            break
+    run_id, event_id = 0, 0
+    if p_frame is not None and 'I3EventHeader' in p_frame:
+        run_id = p_frame['I3EventHeader'].run_id
+        event_id = p_frame['I3EventHeader'].event_id
+    return Header(type=msg_type,
+                  run_id=run_id,
+                  event_id=event_id,
+                  nside=_int_value(p_frame, 'SCAN_HealpixNSide'),
+                  pixel=_int_value(p_frame, 'SCAN_HealpixPixel'),
+                  posvar=_int_value(p_frame, 'SCAN_PositionVariationIndex'),
+                  nframes=len(frames),
+                  packet_hash=packet_hash)
+
+def encode(frames, msg_type=TYPE_DATA, packet_hash=None):
+    """Pack frames into a message"""
+    header = make_header(frames, msg_type, packet_hash)
+    parts = [_header.pack(MAGIC, VERSION, header.type,
+                          header.run_id, header.event_id,
+                          header.nside, header.pixel, header.posvar,
+                          header.nframes,
+                          (packet_hash or '').encode('ascii'))]
+    for fr in frames:
+        blob = fr.dumps()
+        parts.append(_length.pack(len(blob)))
+        parts.append(blob)
+    return b''.join(parts)
+
+def decode_header(data):
+    """Read the header of a message, without touching the frames"""
+    if len(data) < _header.size:
+        raise EnvelopeError('message too short')
+    (magic, version, msg_type, run_id, event_id, nside, pixel, posvar,
+     nframes, packet_hash) = _header.unpack_from(data)
+    if magic != MAGIC:
+        raise EnvelopeError('not a frame envelope')
+    if version != VERSION:
+        raise EnvelopeError('unknown envelope version {}'.format(version))
+    packet_hash = packet_hash.rstrip(b'\0').decode('ascii') or None
+    return Header(msg_type, run_id, event_id, nside, pixel, posvar,
+                  nframes, packet_hash)
+
+def _load_frame(blob):
+    fr = icetray.I3Frame()
+    try:
+        fr.loads(blob)
+    except TypeError:
+        # bindings that only take a byte string
+        fr.loads(blob.tobytes())
+    return fr
+
+def decode_frames(data, header=None):
+    """Unpack the frames of a message, slicing them out of a memoryview"""
+    if header is None:
+        header = decode_header(data)
+    view = memoryview(data)
+    offset = _header.size
+    frames = []
+    for _ in range(header.nframes):
+        if offset+_length.size > len(view):
+            raise EnvelopeError('message truncated')
+        length, = _length.unpack_from(view, offset)
+        offset += _length.size
+        if offset+length > len(view):
+            raise EnvelopeError('message truncated')
+        frames.append(_load_frame(view[offset:offset+length]))
+        offset += length
+    return frames
+
+def write_message(f, data):
+    """Write one length-prefixed message to a stream"""
+    f.write(_length.pack(len(data)))
+    f.write(data)
+    f.flush()
+
+def read_message(f):
+    """Read one length-prefixed message from a stream, or None at the end"""
+    prefix = f.read(_length.size)
+    if not prefix:
+        return None
+    if len(prefix) < _length.size:
+        raise EnvelopeError('stream truncated')
+    length, = _length.unpack(prefix)
+    data = f.read(length)
+    if len(data) < length:
+        raise EnvelopeError('stream truncated')
+    return data
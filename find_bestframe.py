@@ -1,58 +1,83 @@
 import os
 import argparse
-from icecube import dataio,dataclasses
-from icecube.icetray import I3Units
+import multiprocessing
+from icecube import icetray, dataio, dataclasses
 import sys
 sys.path.append('scan')
-from consolidate_scan import FindBestRecoResultForPixel
-from I3Tray import I3Tray
+from consolidate_scan import frame_llh, better_llh
 import glob
 
-def writer(frames):
-    with dataio.I3File(outfile, 'a') as f:
-         f.push(frames)
+def find_best(pf, npos=7):
+    """
+    Read a pixel file once, returning (file, best frame or None, message).
+    Only pixels with all `npos` position variations get a best frame.
+    """
+    best_frame, best_llh = None, float('nan')
+    pos_vars = set()
+    try:
+        for frame in dataio.I3File(pf):
+            if frame.Stop != icetray.I3Frame.Physics:
+                continue
+            pos_vars.add(frame["SCAN_PositionVariationIndex"].value)
+            llh = frame_llh(frame)
+            if best_frame is None or better_llh(llh, best_llh):
+                best_frame, best_llh = frame, llh
+    except Exception as e:
+        return pf, None, "cannot read %s: %s" % (pf, e)
+    if len(pos_vars) < npos:
+        return pf, None, "only position variations %s scanned for %s" % (sorted(pos_vars), pf)
+    # frames go back to the parent process serialized
+    return pf, best_frame.dumps(), "All position variations scanned for pixel %s, best LLH %s" % (
+        best_frame["SCAN_HealpixPixel"].value, best_llh)
 
+def _find_best(job):
+    return find_best(*job)
 
-parser = argparse.ArgumentParser(description = "Read i3 files for all pixels for a scan and find best fit frames")
-parser.add_argument('-i', '--input', dest = 'input',help = 'path to input directory with scan results')
-parser.add_argument('--delete',action='store_true',help = 'delete individual i3 files after finding best fit')
-args = parser.parse_args()
+def main():
+    parser = argparse.ArgumentParser(description = "Read i3 files for all pixels for a scan and find best fit frames")
+    parser.add_argument('-i', '--input', dest = 'input',help = 'path to input directory with scan results')
+    parser.add_argument('-o', '--output', dest = 'output', default = None,
+                        help = 'output file, BestFit_Frames.i3 in the input directory by default')
+    parser.add_argument('-n', '--procs', type = int, default = multiprocessing.cpu_count(),
+                        help = 'number of processes reading pixel files')
+    parser.add_argument('--npos', type = int, default = 7, help = 'No of position variations per pixel')
+    parser.add_argument('--delete',action='store_true',help = 'delete individual i3 files after finding best fit')
+    args = parser.parse_args()
 
-outd = args.input
-outfile = '%s/BestFit_Frames.i3'%outd
+    outfile = args.output or '%s/BestFit_Frames.i3'%args.input
 
-files = sorted(glob.glob('%s/pix*i3'%args.input))
-print("Finding best fit frames for %s pixels" %(len(files)))
-
-for pf in files: 
-   infile = dataio.I3File(pf)
-
-   npos = 7  #No of position variations per pixel
-   pos_vars = []
-   
-   for frame in infile:
-       pos_vars.append(frame["SCAN_PositionVariationIndex"].value)
-   
-   print(sorted(pos_vars))
-   
-   if len(pos_vars)==npos:
-      print("All position variations scanned for pixel %s" %(frame["SCAN_HealpixPixel"].value))
-   
-   #Determine best-fit
-      tray = I3Tray()
-      tray.Add(dataio.I3Reader,Filename=pf)
-      tray.Add(FindBestRecoResultForPixel, "FindBestRecoResultForPixel",NPosVar = npos)
-      tray.Add(writer,"writer")
-      tray.Execute()
-      tray.Finish()
-      del tray
-      if args.delete:
-         print("Deleting Individual Pixel files to free up space")
-         for df in files:
-           os.system("rm %s"%df)
-
-print("Done")
+    files = sorted(glob.glob('%s/pix*i3'%args.input))
+    print("Finding best fit frames for %s pixels" %(len(files)))
 
+    done = []
+    pool = multiprocessing.Pool(args.procs)
+    try:
+        # one writer for all the best frames, in pixel file order
+        out = dataio.I3File(outfile, 'a')
+        try:
+            jobs = [(pf, args.npos) for pf in files]
+            for pf, data, msg in pool.imap(_find_best, jobs, chunksize=16):
+                print(msg)
+                if data is None:
+                    continue
+                frame = icetray.I3Frame()
+                frame.loads(data)
+                out.push(frame)
+                done.append(pf)
+        finally:
+            out.close()
+    finally:
+        pool.close()
+        pool.join()
+    print("Wrote %s best fit frames to %s" % (len(done), outfile))
 
+    if args.delete:
+        # only files whose best frame is safely written
+        print("Deleting %s individual pixel files to free up space" % len(done))
+        for pf in done:
+            os.remove(pf)
 
+    print("Done")
 
+if __name__ == '__main__':
+    main()
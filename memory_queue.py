@@ -0,0 +1,191 @@
+"""
+In-process stand-in for the broker.
+
+`MemorySourceQueue` and `MemorySinkQueue` have the interface of
+`SourceQueue` and `SinkQueue`, so `Source`, `Sink` and the rest of the
+pipeline run unchanged on top of them, with threads in place of separate
+processes and no RabbitMQ needed. Messages keep their compression and
+retry headers, and unacked messages go back on their queue if nacked.
+"""
+import time
+import threading
+import collections
+
+import metrics
+from util import SourceQueue, SinkQueue, packet_queue_name
+
+
+class Properties(object):
+    """The message properties the queues use, as in pika.BasicProperties"""
+    def __init__(self, content_encoding=None, headers=None):
+        self.content_encoding = content_encoding
+        self.headers = headers
+
+
+class MemoryBroker(object):
+    """Named FIFO queues shared by the threads of one process"""
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queues = collections.defaultdict(collections.deque)
+        self.unacked = {} # delivery tag -> (queue, body, properties)
+        self.delivery_tag = 0
+
+    def publish(self, queue, body, properties=None):
+        with self.cond:
+            self.queues[queue].append((body, properties))
+            self.cond.notify_all()
+
+    def get(self, queue, timeout=None):
+        """
+        Take the next message off a queue, waiting up to `timeout` seconds.
+        Returns (delivery_tag, body, properties), or None.
+        """
+        end_time = None if timeout is None else time.time()+timeout
+        with self.cond:
+            while not self.queues[queue]:
+                if end_time is None:
+                    self.cond.wait(1)
+                    continue
+                remaining = end_time-time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+            body, properties = self.queues[queue].popleft()
+            self.delivery_tag += 1
+            self.unacked[self.delivery_tag] = (queue, body, properties)
+            return self.delivery_tag, body, properties
+
+    def peek(self, queue):
+        """The message at the front of a queue, left in place, or None"""
+        with self.cond:
+            if not self.queues[queue]:
+                return None
+            return self.queues[queue][0]
+
+    def ack(self, delivery_tag):
+        with self.cond:
+            self.unacked.pop(delivery_tag, None)
+
+    def nack(self, delivery_tag):
+        """Put an unacked message back at the front of its queue"""
+        with self.cond:
+            if delivery_tag not in self.unacked:
+                return
+            queue, body, properties = self.unacked.pop(delivery_tag)
+            self.queues[queue].appendleft((body, properties))
+            self.cond.notify_all()
+
+    def depth(self, queue):
+        with self.cond:
+            return len(self.queues[queue])
+
+# the broker used unless a queue is given another one
+BROKER = MemoryBroker()
+
+
+class MemoryQueueMixin(object):
+    """Replaces the pika connection of a RawQueue with a MemoryBroker"""
+    def __enter__(self):
+        if self.broker is None:
+            self.broker = BROKER
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def keepalive(self):
+        pass
+
+    def declare_packet(self, packet_hash):
+        return self.broker.depth(packet_queue_name(packet_hash))
+
+class MemorySourceQueue(MemoryQueueMixin, SourceQueue):
+    def __init__(self, address='memory', queue='test', compression=None, broker=None, **kwargs):
+        super(MemorySourceQueue, self).__init__(address, queue, compression=compression, **kwargs)
+        self.broker = broker
+
+    def encode_body(self, data):
+        body, properties = super(MemorySourceQueue, self).encode_body(data)
+        return body, Properties(content_encoding=properties.content_encoding)
+
+    def send(self, data):
+        body, properties = self.encode_body(data)
+        self.broker.publish(self.queue, body, properties)
+
+    def send_packet(self, packet_hash, data):
+        if self.declare_packet(packet_hash) > 0:
+            return False
+        body, properties = self.encode_body(data)
+        self.broker.publish(packet_queue_name(packet_hash), body, properties)
+        return True
+
+class MemorySinkQueue(MemoryQueueMixin, SinkQueue):
+    def __init__(self, callback=None, timeout=120, max_retries=3, address='memory',
+                 queue='test', broker=None, **kwargs):
+        super(MemorySinkQueue, self).__init__(callback, timeout, max_retries,
+                                              address=address, queue=queue, **kwargs)
+        self.broker = broker
+
+    def start_recv(self, callback=None):
+        """Blocking recv call, returning after `timeout` idle seconds"""
+        if callback:
+            self.callback = callback
+        self.running = True
+        while self.running:
+            msg = self.broker.get(self.queue, self.timeout)
+            if msg is None:
+                print('idle timeout hit')
+                break
+            delivery_tag, body, properties = msg
+            self.last_time = time.time()
+            metrics.IDLE.labels(self.queue).inc(self.last_time-self.idle_since)
+            self.count_received(body)
+            try:
+                self.run_callback(delivery_tag, body, properties)
+            finally:
+                self.idle_since = time.time()
+
+    def stop(self, *args, **kwargs):
+        self.running = False
+
+    def receive(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        msg = self.broker.get(self.queue, timeout)
+        if msg is not None:
+            self.count_received(msg[1])
+        return msg
+
+    def get(self, timeout=None):
+        msg = self.receive(timeout)
+        if msg is None:
+            return None
+        delivery_tag, body, properties = msg
+        self.ack(delivery_tag)
+        return self.decode_body(properties, body)
+
+    def ack(self, delivery_tag):
+        metrics.MESSAGES.labels(self.queue, 'acked').inc()
+        self.broker.ack(delivery_tag)
+
+    def nack(self, delivery_tag):
+        metrics.MESSAGES.labels(self.queue, 'nacked').inc()
+        self.broker.nack(delivery_tag)
+
+    def republish(self, delivery_tag, routing_key, body, properties, headers):
+        properties = Properties(
+            content_encoding=properties.content_encoding if properties else None,
+            headers=headers)
+        self.broker.publish(routing_key, body, properties)
+        self.broker.ack(delivery_tag)
+
+    def fetch_packet(self, packet_hash, timeout=60):
+        end_time = time.time()+timeout
+        while True:
+            msg = self.broker.peek(packet_queue_name(packet_hash))
+            if msg is not None:
+                body, properties = msg
+                return self.decode_body(properties, body)
+            if time.time() > end_time:
+                raise Exception('frame packet {} not available'.format(packet_hash))
+            time.sleep(0.1)
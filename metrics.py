@@ -0,0 +1,95 @@
+"""
+Prometheus metrics for the scan processes.
+
+The metrics are always there to update, but only served over HTTP after
+`start_server`, which needs the `prometheus_client` package. Without it,
+updates do nothing.
+"""
+import json
+import socket
+import logging
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+# fit times go from seconds to hours
+FIT_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400)
+
+
+class NullMetric(object):
+    """Stand-in that ignores updates, when prometheus_client is missing"""
+    def labels(self, *args, **kwargs):
+        return self
+    def inc(self, amount=1):
+        pass
+    def dec(self, amount=1):
+        pass
+    def set(self, value):
+        pass
+    def observe(self, value):
+        pass
+
+def _metric(kind, name, doc, labels, **kwargs):
+    if prometheus_client is None:
+        return NullMetric()
+    return getattr(prometheus_client, kind)(name, doc, labels, **kwargs)
+
+MESSAGES = _metric('Counter', 'scan_messages_total',
+                   'messages sent, received, acked, nacked, retried and dead-lettered',
+                   ['queue', 'action'])
+BYTES = _metric('Counter', 'scan_message_bytes_total',
+                'message bytes on the wire', ['queue', 'direction'])
+IDLE = _metric('Counter', 'scan_idle_seconds_total',
+               'seconds spent waiting for messages with nothing to do', ['queue'])
+IN_FLIGHT = _metric('Gauge', 'scan_messages_in_flight',
+                    'messages received and not yet acked or nacked', ['queue'])
+FIT_SECONDS = _metric('Histogram', 'scan_fit_seconds',
+                      'fit duration of a pixel', ['nside'], buckets=FIT_BUCKETS)
+STAGE_SECONDS = _metric('Histogram', 'scan_stage_seconds',
+                        'duration of each stage of a pixel', ['stage'], buckets=FIT_BUCKETS)
+
+
+def start_server(port, name=None, reconfig=None, address=None):
+    """
+    Serve the metrics on `port`. With `reconfig`, the address of a
+    prometheus-reconfig service, add this process as a target of its
+    `scan` job under `name`.
+    """
+    if prometheus_client is None:
+        raise Exception('metrics need the prometheus_client package')
+    prometheus_client.start_http_server(port)
+    print('serving metrics on port {}'.format(port))
+    if reconfig:
+        if address is None:
+            address = socket.getfqdn()
+        if ':' in address:
+            address = '['+address+']'
+        register_target(reconfig, 'scan', name or 'scan', '{}:{}'.format(address, port))
+
+def register_target(reconfig, job, name, target):
+    """PATCH a target into a prometheus-reconfig job, like the fleet user data does"""
+    import requests
+    url = '{}/{}/{}'.format(reconfig.rstrip('/'), job, name)
+    try:
+        r = requests.patch(url, data=json.dumps({'targets': [target]}))
+        r.raise_for_status()
+    except Exception:
+        logging.warning('cannot register metrics target %s', target, exc_info=True)
+    else:
+        print('registered metrics target', target, 'at', url)
+
+def add_arguments(parser):
+    parser.add_argument('--metrics-port', dest='metrics_port', type=int, default=None,
+                        help='serve prometheus metrics on this port')
+    parser.add_argument('--metrics-reconfig', dest='metrics_reconfig', default=None,
+                        help='prometheus-reconfig service to register the metrics with, e.g. http://monitoring:8080')
+    parser.add_argument('--metrics-address', dest='metrics_address', default=None,
+                        help='address prometheus scrapes this process on, the host name by default')
+
+def setup(args, name):
+    """Start the metrics server if the command line asks for it"""
+    if args.metrics_port:
+        start_server(args.metrics_port, name=name, reconfig=args.metrics_reconfig,
+                     address=args.metrics_address)
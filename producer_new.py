@@ -1,15 +1,20 @@
 from __future__ import print_function
 import argparse
+from functools import partial
 import sys
+import time
 from icecube import icetray,dataio,dataclasses
 from I3Tray import I3Tray
 import json
-from util import SourceQueue, Source, get_parser
+import metrics
+from util import SourceQueue, ConfirmSourceQueue, Source, SinkQueue, Sink, DataError, get_parser, peek_dead_letters
 
 sys.path.append('inframe_maker')
 sys.path.append('scan')
 from frame_gen import extract_json_message
 from send_scan import SendPixelsToScan
+from scan_utils import hash_frame_packet, get_event_header, get_event_id
+from refine_scan import RefinementScheduler
 
 class SimpleSource(icetray.I3Module):
     '''
@@ -19,39 +24,210 @@ class SimpleSource(icetray.I3Module):
         icetray.I3Module.__init__(self, context)
         self.AddParameter('json', 'frame packet extracted from json file', None)
     def Configure(self):
-	self.json = self.GetParameter('json')
+        self.json = self.GetParameter('json')
     def Process(self):
         if self.json:
-	   f = self.json.pop(0)
+           f = self.json.pop(0)
            self.PushFrame(f)
         else:
-	   self.RequestSuspension()
+           self.RequestSuspension()
 
 
 class FramePacker(icetray.I3Module):
     def __init__(self, context):
         icetray.I3Module.__init__(self, context)
         self.AddParameter('sender', 'sender function', None)
+        self.AddParameter('packet_sender', 'sender function for shared frame packets', None)
+        self.AddParameter('batch_size', 'P-frames per message, an int or a dict of nside to int', 1)
+        self.AddParameter('batch_time', 'max seconds to hold P-frames back for a full batch', None)
         self.sender = None
+        self.packet_sender = None
+        self.packet_hash = None
+        self.packet = []
+        self.batch = []
+        self.batch_start = None
         self.frames = []
         self.accept_frames = [icetray.I3Frame.DAQ, icetray.I3Frame.Physics]
     def Configure(self):
         self.sender = self.GetParameter('sender')
+        self.packet_sender = self.GetParameter('packet_sender')
+        self.batch_size = self.GetParameter('batch_size')
+        self.batch_time = self.GetParameter('batch_time')
     def Process(self):
-	fr = self.PopFrame()
-        self.frames.append(fr)
-	print(fr.Stop)
-	if fr.Stop == icetray.I3Frame.Physics:
-        #if self.frames:
-                self.sender(self.frames)
-                self.frames = []
+        fr = self.PopFrame()
+        print(fr.Stop)
+        if fr.Stop != icetray.I3Frame.Physics:
+            self.frames.append(fr)
+            return
+        if self.frames:
+            # frames ahead of a P-frame form a new packet
+            self.new_packet(self.frames)
+            self.frames = []
+        if not self.batch:
+            self.batch_start = time.time()
+        self.batch.append(fr)
+        if (len(self.batch) >= self.get_batch_size(fr) or
+            (self.batch_time is not None and time.time()-self.batch_start >= self.batch_time)):
+            self.send_batch()
+    def Finish(self):
+        self.send_batch()
+    def new_packet(self, frames):
+        if self.packet_sender:
+            # stored once and then referenced by hash
+            packet_hash = hash_frame_packet(frames)
+            if packet_hash != self.packet_hash:
+                self.send_batch()
+                self.packet_hash = packet_hash
+                self.packet_sender(self.packet_hash, frames)
+        elif not self.batch:
+            # a tray only scans one event, so the GCDQ frames repeated
+            # ahead of every P-frame are sent once per batch
+            self.packet = frames
+    def get_batch_size(self, fr):
+        if isinstance(self.batch_size, dict):
+            nside = fr["SCAN_HealpixNSide"].value
+            return self.batch_size.get(nside, self.batch_size.get(None, 1))
+        return self.batch_size
+    def send_batch(self):
+        if not self.batch:
+            return
+        if self.packet_sender:
+            self.sender(self.batch, packet_hash=self.packet_hash)
+        else:
+            self.sender(self.packet+self.batch)
+        self.batch = []
+
+def parse_batch_sizes(values):
+    """Parse "size" or "nside:size" items into a dict of nside to batch size"""
+    sizes = {}
+    for v in values:
+        if ':' in v:
+            nside, size = v.split(':')
+            sizes[int(nside)] = int(size)
+        else:
+            sizes[None] = int(v)
+    return sizes
+
+def send_pixels(source, fpacket, nside, pixels=None, packet_once=False,
+                batch_size=1, batch_time=None, warm_seeds=None, best_llh=None):
+    """Send one P-frame per pixel and position variation"""
+    tray = I3Tray()
+    tray.AddModule(SendPixelsToScan, "SendPixelsToScan",
+        FramePacket=fpacket,
+        NSide=nside,
+        Pixels=pixels,
+        InputTimeName="HESE_VHESelfVetoVertexTime",
+        InputPosName="HESE_VHESelfVetoVertexPos",
+        OutputParticleName="MillipedeSeedParticle",
+        SendPacketOnce=packet_once,
+        WarmSeeds=warm_seeds,
+        BestLLH=best_llh,
+    )
+    tray.Add(FramePacker, sender=source.send,
+             packet_sender=source.send_packet if packet_once else None,
+             batch_size=batch_size, batch_time=batch_time)
+    tray.Execute()
+    tray.Finish()
+    del tray
+    failed = source.flush()
+    if failed:
+        print("{} pixel messages could not be sent".format(len(failed)))
+
+# seconds without results before looking for dead-lettered pixels
+DEAD_LETTER_CHECK = 60
+
+def dead_lettered_pixels(results, address, queues, event_header):
+    """(nside, pixel, posvar) of the pixels of an event dead-lettered from `queues`"""
+    def accept(header):
+        return (header.run_id, header.event_id) == (event_header.run_id, event_header.event_id)
+    pixels = set()
+    for queue in queues:
+        for data in peek_dead_letters(address, queue):
+            try:
+                header, frames = results.unpack(data, accept)
+            except DataError:
+                continue
+            for fr in frames or []:
+                if fr.Stop == icetray.I3Frame.Physics and "SCAN_HealpixPixel" in fr:
+                    pixels.add((fr["SCAN_HealpixNSide"].value, fr["SCAN_HealpixPixel"].value,
+                                fr["SCAN_PositionVariationIndex"].value))
+    return pixels
+
+def refine_scan(source, results, fpacket, scheduler, packet_once=False, timeout=600,
+                batch_size=1, batch_time=None, warm_seed=False, dead_letters=None):
+    """
+    Scan level by level, choosing the pixels of each level from the
+    results of the level before it as they arrive. Once results stop
+    arriving, the pixels `dead_letters()` returns count as done, as they
+    will never have a result. Give up waiting on a level after `timeout`
+    seconds without results. With `warm_seed`, pixels get seeded from
+    the fits around them at the level before.
+    """
+    pixels = scheduler.next_level()
+    while pixels is not None:
+        print("Scanning {} pixels at nside {}".format(len(pixels), scheduler.nside))
+        warm_seeds = None
+        if warm_seed:
+            warm_seeds = scheduler.warm_seeds(scheduler.nside, pixels)
+            print("{} pixels have a warm seed".format(len(warm_seeds)))
+        send_pixels(source, fpacket, scheduler.nside, pixels, packet_once=packet_once,
+                    batch_size=batch_size, batch_time=batch_time, warm_seeds=warm_seeds,
+                    best_llh=scheduler.best_1st_pass_llh())
+        last_time = last_check = time.time()
+        while not scheduler.level_done():
+            frames = results.get(10)
+            # the source connection sits idle while the fits run
+            source.queue.keepalive()
+            if frames is None:
+                now = time.time()
+                if dead_letters and now-max(last_time, last_check) > DEAD_LETTER_CHECK:
+                    last_check = now
+                    for nside, pixel, posvar in dead_letters():
+                        if nside == scheduler.nside:
+                            scheduler.add_failed(nside, pixel, posvar)
+                    continue
+                if now-last_time > timeout:
+                    print("timed out waiting for results at nside", scheduler.nside)
+                    break
+                continue
+            last_time = time.time()
+            scheduler.add_frame(frames[-1])
+        pixels = scheduler.next_level()
 
 def main():
     parser = get_parser()
     #parser.add_argument('infile', help='input i3 file')
     parser.add_argument('infile', help='input json or i3 file')
+    parser.add_argument('--packet-once', dest='packet_once', action='store_true',
+                        help='send the GCDQ packet once and reference it by hash in every pixel message')
+    parser.add_argument('--confirm-window', dest='confirm_window', type=int, default=0,
+                        help='use publisher confirms with this many messages outstanding (0 disables)')
+    parser.add_argument('--batch', nargs='+', default=['1'],
+                        help='P-frames per message, as "size" or per nside as "nside:size"')
+    parser.add_argument('--batch-time', dest='batch_time', type=float, default=None,
+                        help='max seconds to hold P-frames back for a full batch')
+    parser.add_argument('--nside', type=int, default=1, help='healpix nside of a uniform scan')
+    parser.add_argument('--refine', type=int, nargs='+', default=None,
+                        help='nside of each level of an adaptive scan, e.g. 8 64 512')
+    parser.add_argument('--nbest', type=int, default=12,
+                        help='number of best pixels refined at each level')
+    parser.add_argument('-r', '--results-exchange', dest='results_exchange', default=None,
+                        help='exchange the consumers publish results to, needed by --refine')
+    parser.add_argument('--results-timeout', dest='results_timeout', type=int, default=600,
+                        help='seconds to wait for more results before refining anyway')
+    parser.add_argument('--work-queue', dest='work_queues', nargs='+', default=None,
+                        help='queues whose dead-lettered pixels count as done, the -q queue by default')
+    parser.add_argument('--warm-seed', dest='warm_seed', action='store_true',
+                        help='with --refine, seed pixels from the fits around them at the level before')
     args = parser.parse_args()
+    metrics.setup(args, 'producer')
     
+    if args.refine and not args.results_exchange:
+        parser.error('--refine needs a --results-exchange')
+    if args.warm_seed and not args.refine:
+        parser.error('--warm-seed needs --refine')
+    batch_size = parse_batch_sizes(args.batch)
+
     json_blob_handle = args.infile
 
     if len(json_blob_handle) == 0:
@@ -68,18 +244,38 @@ def main():
        del json_blob_handle
        
        fpacket = extract_json_message(event)
-    with SourceQueue(args.address, args.queue) as queue:
+    if args.confirm_window > 0:
+        out_queue = ConfirmSourceQueue(address=args.address, queue=args.queue,
+                                       window=args.confirm_window,
+                                       compression=args.compression)
+    else:
+        out_queue = SourceQueue(args.address, args.queue, compression=args.compression)
+    with out_queue as queue:
         s = Source(queue)
-        tray = I3Tray()
-	tray.AddModule(SendPixelsToScan, "SendPixelsToScan",
-        FramePacket=fpacket,
-        NSide=1,
-        InputTimeName="HESE_VHESelfVetoVertexTime",
-        InputPosName="HESE_VHESelfVetoVertexPos",
-        OutputParticleName="MillipedeSeedParticle",
-    )
-        tray.Add(FramePacker, sender=s.send)
-        tray.Execute()
+        if args.refine:
+            event_header = get_event_header(fpacket)
+            scheduler = RefinementScheduler(args.refine, n_best=args.nbest,
+                                            event_header=event_header)
+            # a results queue of our own, bound before any pixel is sent
+            results_name = '{}.{}'.format(args.results_exchange, get_event_id(fpacket))
+            with SinkQueue(address=args.address, queue=results_name,
+                           exchange=args.results_exchange,
+                           timeout=args.timeout) as results_queue:
+                try:
+                    results = Sink(results_queue, None)
+                    dead_letters = partial(dead_lettered_pixels, results, args.address,
+                                           args.work_queues or [args.queue], event_header)
+                    refine_scan(s, results, fpacket, scheduler, packet_once=args.packet_once,
+                                timeout=args.results_timeout,
+                                batch_size=batch_size, batch_time=args.batch_time,
+                                warm_seed=args.warm_seed, dead_letters=dead_letters)
+                finally:
+                    # or it would keep collecting the results of later scans
+                    results_queue.channel.queue_delete(queue=results_queue.queue)
+                    results_queue.channel.queue_delete(queue=results_queue.dead_letter_queue)
+        else:
+            send_pixels(s, fpacket, args.nside, packet_once=args.packet_once,
+                        batch_size=batch_size, batch_time=args.batch_time)
 
     print('done!')
 
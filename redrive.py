@@ -0,0 +1,21 @@
+from __future__ import print_function
+import argparse
+
+from util import redrive
+
+def main():
+    parser = argparse.ArgumentParser(description='Send dead-lettered messages back to their queue')
+    parser.add_argument('-a', '--address', default='localhost', help='rabbitmq host')
+    parser.add_argument('-q', '--queue', default='test', help='queue name, whose dead letters to re-drive')
+    parser.add_argument('-n', '--limit', type=int, default=None, help='max number of messages to move')
+    parser.add_argument('--show', action='store_true', help='only print the errors, do not move anything')
+    args = parser.parse_args()
+
+    count = redrive(args.address, args.queue, limit=args.limit, show=args.show)
+    if args.show:
+        print(count, 'dead-lettered messages')
+    else:
+        print(count, 'messages sent back to', args.queue)
+
+if __name__ == '__main__':
+    main()
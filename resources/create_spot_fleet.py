@@ -15,6 +15,7 @@ from textwrap import dedent
 import boto3
 import botocore
 import requests
+from urllib.parse import quote
 
 
 class Specs(dict):
@@ -264,6 +265,114 @@ class SpotFleet:
             print('fleet terminated')
 
 
+class QueueStats:
+    """Depth and ack rate of a queue, from the RabbitMQ management API"""
+    def __init__(self, address, queue, vhost='/', auth=('guest', 'guest')):
+        self.address = address.rstrip('/')
+        self.queue = queue
+        self.vhost = vhost
+        self.auth = auth
+
+    def get(self):
+        """Returns (messages in the queue, consumers, acks per second)"""
+        url = '{}/api/queues/{}/{}'.format(self.address, quote(self.vhost, safe=''),
+                                           quote(self.queue, safe=''))
+        r = requests.get(url, auth=self.auth, timeout=10)
+        r.raise_for_status()
+        ret = r.json()
+        depth = ret.get('messages', 0)
+        consumers = ret.get('consumers', 0)
+        try:
+            ack_rate = ret['message_stats']['ack_details']['rate']
+        except KeyError:
+            ack_rate = 0.
+        return depth, consumers, ack_rate
+
+
+class FleetAutoscaler:
+    """
+    Grow or shrink a spot fleet to empty a queue in `target_time` seconds.
+
+    Every `interval` seconds, the queue depth, consumers and ack rate are
+    read with `stats`. The ack rate per instance is estimated from the
+    consumers that are actually acking, one per instance, and the fleet
+    target capacity is set to the number of instances that would finish
+    the queue in time, between `min_num` and `max_num`. The fleet is not
+    grown again while an earlier change is still being fulfilled, as new
+    instances take minutes to start. Once the queue has been empty for
+    `drain_polls` polls, the fleet goes down to `min_num`.
+
+    Shrinking never terminates instances: they drain their work and shut
+    down once their worker hits its idle timeout. Only the
+    describe_spot_fleet_requests and modify_spot_fleet_request calls of
+    the `ec2` client are used.
+    """
+    def __init__(self, ec2, fleet_id, stats, target_time=3600, min_num=0, max_num=100,
+                 interval=60, drain_polls=3, instance_rate=None):
+        self.ec2 = ec2
+        self.fleet_id = fleet_id
+        self.stats = stats
+        self.target_time = target_time
+        self.min_num = min_num
+        self.max_num = max_num
+        self.interval = interval
+        self.drain_polls = drain_polls
+        self.instance_rate = instance_rate # acks per second per instance
+        self.empty_polls = 0
+
+    def capacity(self):
+        """Returns (target capacity, fulfilled capacity, whether a change is pending)"""
+        ret = self.ec2.describe_spot_fleet_requests(SpotFleetRequestIds=[self.fleet_id])
+        fleet = ret['SpotFleetRequestConfigs'][0]
+        config = fleet['SpotFleetRequestConfig']
+        target = config['TargetCapacity']
+        fulfilled = config.get('FulfilledCapacity', target)
+        pending = (fleet.get('SpotFleetRequestState') == 'modifying' or
+                   fleet.get('ActivityStatus') == 'pending_fulfillment' or
+                   fulfilled < target)
+        return target, fulfilled, pending
+
+    def desired(self, depth, consumers, ack_rate, current):
+        """Target capacity for the queue state"""
+        if depth == 0:
+            self.empty_polls += 1
+            if self.empty_polls >= self.drain_polls:
+                return self.min_num
+            return current
+        self.empty_polls = 0
+        if consumers > 0 and ack_rate > 0:
+            self.instance_rate = ack_rate/consumers
+        if not self.instance_rate:
+            # nothing to go by until work gets done, so start one up
+            return max(current, min(1, self.max_num), self.min_num)
+        num = int(math.ceil(depth/(self.instance_rate*self.target_time)))
+        return max(self.min_num, min(self.max_num, num))
+
+    def step(self):
+        depth, consumers, ack_rate = self.stats.get()
+        current, fulfilled, pending = self.capacity()
+        num = self.desired(depth, consumers, ack_rate, current)
+        print(f'autoscale: {depth} messages, {consumers} consumers, {ack_rate:.3f} acks/s, capacity {fulfilled}/{current} -> {num}')
+        if num > current and pending:
+            print('autoscale: waiting for the last change to be fulfilled')
+            return current
+        if num != current:
+            self.ec2.modify_spot_fleet_request(
+                SpotFleetRequestId=self.fleet_id,
+                TargetCapacity=num,
+                ExcessCapacityTerminationPolicy='noTermination',
+            )
+        return num
+
+    async def run(self):
+        while True:
+            try:
+                self.step()
+            except Exception as e:
+                print('autoscale failed:', e)
+            await asyncio.sleep(self.interval)
+
+
 @contextlib.asynccontextmanager
 async def setup_monitoring(address, target, token=None, service='ec2-test'):
     """Setup prometheus monitoring for target"""
@@ -294,6 +403,18 @@ async def main():
                         help='Prometheus reconfig token from token service')
     parser.add_argument('-n','--num', default=1, type=int,
                         help='number of servers in the worker pool')
+    parser.add_argument('--autoscale', action='store_true',
+                        help='scale the worker pool with the depth of the work queue')
+    parser.add_argument('--autoscale-queue', default='inqueue',
+                        help='queue the worker pool consumes')
+    parser.add_argument('--target-minutes', default=60, type=float,
+                        help='time to empty the queue that the pool is scaled for')
+    parser.add_argument('--min-num', default=0, type=int,
+                        help='fewest servers in an autoscaled pool')
+    parser.add_argument('--max-num', default=100, type=int,
+                        help='most servers in an autoscaled pool')
+    parser.add_argument('--rabbitmq-api', default=None,
+                        help='RabbitMQ management API address, the queue server by default')
     args = vars(parser.parse_args())
 
 
@@ -335,6 +456,12 @@ async def main():
         - files:
            - /etc/prometheus/rabbitmq_targets.json
           refresh_interval: 15s
+      - job_name: 'scan'
+        honor_labels: true
+        file_sd_configs:
+        - files:
+           - /etc/prometheus/scan_targets.json
+          refresh_interval: 15s
     EOF
     cat >$PWD/system_targets.json <<EOF
     [{
@@ -348,6 +475,8 @@ async def main():
     chmod a+rw $PWD/system_targets.json
     echo "[]" >$PWD/rabbitmq_targets.json
     chmod a+rw $PWD/rabbitmq_targets.json
+    echo "[]" >$PWD/scan_targets.json
+    chmod a+rw $PWD/scan_targets.json
     cat >$PWD/prometheus_reconfig.json <<EOF
     {
       "services": [
@@ -356,6 +485,9 @@ async def main():
         },
         {"name": "rabbitmq",
          "filename": "/rabbitmq_targets.json"
+        },
+        {"name": "scan",
+         "filename": "/scan_targets.json"
         }
       ]
     }
@@ -363,8 +495,8 @@ async def main():
 
     printf "\\n%s\\n"  "Running docker"
     docker pull wipac/prometheus-reconfig:latest
-    docker run --rm -d -p 8080:8080 -v $PWD/prometheus_reconfig.json:/etc/prometheus_reconfig.json -v $PWD/system_targets.json:/system_targets.json -v $PWD/rabbitmq_targets.json:/rabbitmq_targets.json wipac/prometheus-reconfig:latest
-    docker run --rm --network host -v $PWD/prometheus.yml:/etc/prometheus/prometheus.yml -v $PWD/system_targets.json:/etc/prometheus/system_targets.json -v $PWD/rabbitmq_targets.json:/etc/prometheus/rabbitmq_targets.json prom/prometheus
+    docker run --rm -d -p 8080:8080 -v $PWD/prometheus_reconfig.json:/etc/prometheus_reconfig.json -v $PWD/system_targets.json:/system_targets.json -v $PWD/rabbitmq_targets.json:/rabbitmq_targets.json -v $PWD/scan_targets.json:/scan_targets.json wipac/prometheus-reconfig:latest
+    docker run --rm --network host -v $PWD/prometheus.yml:/etc/prometheus/prometheus.yml -v $PWD/system_targets.json:/etc/prometheus/system_targets.json -v $PWD/rabbitmq_targets.json:/etc/prometheus/rabbitmq_targets.json -v $PWD/scan_targets.json:/etc/prometheus/scan_targets.json prom/prometheus
     printf "\\n%s\\n"  "Docker is complete, shutting down"
     shutdown -hP now
     """
@@ -495,6 +627,14 @@ async def main():
         futures.append(consumer.monitor(spec['hours']*3600))
         await stack.enter_async_context(fleet)
 
+        if args['autoscale']:
+            api = args['rabbitmq_api'] or f'http://[{queue_server.ipv6_address}]:15672'
+            autoscaler = FleetAutoscaler(ec2, fleet.fleet_id,
+                                         QueueStats(api, args['autoscale_queue']),
+                                         target_time=args['target_minutes']*60,
+                                         min_num=args['min_num'], max_num=args['max_num'])
+            futures.append(autoscaler.run())
+
         await asyncio.wait(futures, return_when=asyncio.FIRST_EXCEPTION)
 
 if __name__ == '__main__':
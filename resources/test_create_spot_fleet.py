@@ -0,0 +1,163 @@
+"""
+Tests for the spot fleet autoscaler, against a local stand-in for the
+RabbitMQ management API and a fake EC2 client.
+
+    python -m unittest discover -s resources
+"""
+import os
+import sys
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from create_spot_fleet import QueueStats, FleetAutoscaler
+
+
+class ManagementAPI(HTTPServer):
+    """Serves /api/queues/<vhost>/<queue> from the `queues` dict"""
+    def __init__(self):
+        super().__init__(('localhost', 0), ManagementHandler)
+        self.queues = {}
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def address(self):
+        return 'http://localhost:{}'.format(self.server_address[1])
+
+    def set_queue(self, name, messages, consumers, ack_rate=None):
+        ret = {'name': name, 'messages': messages, 'consumers': consumers}
+        if ack_rate is not None:
+            ret['message_stats'] = {'ack_details': {'rate': ack_rate}}
+        self.queues['/api/queues/%2F/'+name] = ret
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class ManagementHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in self.server.queues:
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.queues[self.path]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeEC2:
+    """The spot fleet calls of an ec2 client, with capacity fulfilled by hand"""
+    def __init__(self, target=1, fulfilled=None):
+        self.target = target
+        self.fulfilled = target if fulfilled is None else fulfilled
+        self.modifications = []
+
+    def describe_spot_fleet_requests(self, SpotFleetRequestIds):
+        return {'SpotFleetRequestConfigs': [{
+            'SpotFleetRequestId': SpotFleetRequestIds[0],
+            'SpotFleetRequestState': 'active',
+            'ActivityStatus': 'fulfilled' if self.fulfilled >= self.target else 'pending_fulfillment',
+            'SpotFleetRequestConfig': {
+                'TargetCapacity': self.target,
+                'FulfilledCapacity': float(self.fulfilled),
+            },
+        }]}
+
+    def modify_spot_fleet_request(self, SpotFleetRequestId, TargetCapacity,
+                                  ExcessCapacityTerminationPolicy):
+        self.modifications.append((TargetCapacity, ExcessCapacityTerminationPolicy))
+        self.target = TargetCapacity
+
+    def fulfill(self):
+        self.fulfilled = self.target
+
+
+class TestAutoscaler(unittest.TestCase):
+    def setUp(self):
+        self.api = ManagementAPI()
+        self.stats = QueueStats(self.api.address, 'inqueue')
+
+    def tearDown(self):
+        self.api.stop()
+
+    def autoscaler(self, ec2, **kwargs):
+        return FleetAutoscaler(ec2, 'sfr-test', self.stats, **kwargs)
+
+    def test_queue_stats(self):
+        self.api.set_queue('inqueue', 120, 3, 1.5)
+        self.assertEqual(self.stats.get(), (120, 3, 1.5))
+        # no acks yet
+        self.api.set_queue('inqueue', 120, 0)
+        self.assertEqual(self.stats.get(), (120, 0, 0.))
+
+    def test_scale_up(self):
+        ec2 = FakeEC2(target=1)
+        scaler = self.autoscaler(ec2, target_time=3600, max_num=100)
+        # 0.5 acks/s per instance, so 7200 messages need 4 for an hour
+        self.api.set_queue('inqueue', 7200, 1, 0.5)
+        self.assertEqual(scaler.step(), 4)
+        self.assertEqual(ec2.modifications, [(4, 'noTermination')])
+
+    def test_no_growth_while_pending(self):
+        ec2 = FakeEC2(target=1)
+        scaler = self.autoscaler(ec2, target_time=3600, max_num=100)
+        self.api.set_queue('inqueue', 7200, 1, 0.5)
+        scaler.step()
+        # the new instances are still starting, and the old one acks as before
+        for _ in range(5):
+            self.api.set_queue('inqueue', 7000, 1, 0.5)
+            self.assertEqual(scaler.step(), 4)
+        self.assertEqual(ec2.modifications, [(4, 'noTermination')])
+
+    def test_rate_from_consumers(self):
+        ec2 = FakeEC2(target=4, fulfilled=4)
+        scaler = self.autoscaler(ec2, target_time=3600, max_num=100)
+        # only two of the four instances have a worker running yet
+        self.api.set_queue('inqueue', 7200, 2, 1.)
+        self.assertEqual(scaler.step(), 4)
+        self.assertEqual(ec2.modifications, [])
+        self.assertAlmostEqual(scaler.instance_rate, 0.5)
+
+    def test_limits(self):
+        ec2 = FakeEC2(target=1)
+        scaler = self.autoscaler(ec2, target_time=60, min_num=1, max_num=10)
+        self.api.set_queue('inqueue', 100000, 1, 0.5)
+        self.assertEqual(scaler.step(), 10)
+        ec2.fulfill()
+        self.api.set_queue('inqueue', 10, 10, 5.)
+        self.assertEqual(scaler.step(), 1)
+
+    def test_first_instance(self):
+        ec2 = FakeEC2(target=0)
+        scaler = self.autoscaler(ec2)
+        self.api.set_queue('inqueue', 50, 0)
+        self.assertEqual(scaler.step(), 1)
+
+    def test_drain(self):
+        ec2 = FakeEC2(target=5)
+        scaler = self.autoscaler(ec2, min_num=0, drain_polls=3)
+        self.api.set_queue('inqueue', 0, 5, 0.)
+        self.assertEqual(scaler.step(), 5)
+        self.assertEqual(scaler.step(), 5)
+        self.assertEqual(scaler.step(), 0)
+        self.assertEqual(ec2.modifications, [(0, 'noTermination')])
+
+    def test_shrink_while_pending(self):
+        # spot capacity that never arrives must not keep the fleet up
+        ec2 = FakeEC2(target=5, fulfilled=2)
+        scaler = self.autoscaler(ec2, min_num=0, drain_polls=1)
+        self.api.set_queue('inqueue', 0, 2, 0.)
+        self.assertEqual(scaler.step(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,33 +20,90 @@ import config
 
 from scan_utils import get_event_mjd
 from scan_utils import save_GCD_frame_packet_to_file
+from stage_timing import add_stage_time
+from scan_index import IndexWriter, frame_row
 
 
 
+def pixel_key(frame):
+    """(run_id, event_id, nside, pixel) of a scan P-frame"""
+    header = frame["I3EventHeader"]
+    return (header.run_id, header.event_id,
+            frame["SCAN_HealpixNSide"].value, frame["SCAN_HealpixPixel"].value)
+
+# marks a P-frame asking for the best frame so far of an incomplete pixel
+GIVE_UP_PIXEL = "SCAN_GiveUpPixel"
+
+def give_up_frame(key):
+    """P-frame giving up on the pixel `key` from `pixel_key`"""
+    run_id, event_id, nside, pixel = key
+    header = dataclasses.I3EventHeader()
+    header.run_id = run_id
+    header.event_id = event_id
+    frame = icetray.I3Frame(icetray.I3Frame.Physics)
+    frame["I3EventHeader"] = header
+    frame["SCAN_HealpixNSide"] = icetray.I3Int(nside)
+    frame["SCAN_HealpixPixel"] = icetray.I3Int(pixel)
+    frame[GIVE_UP_PIXEL] = icetray.I3Bool(True)
+    return frame
+
+def frame_llh(frame):
+    if "MillipedeStarting2ndPass_millipedellh" in frame:
+        return frame["MillipedeStarting2ndPass_millipedellh"].logl
+    return numpy.nan
+
+def better_llh(llh, best_llh):
+    """Does `llh` beat `best_llh`? An LLH beats none at all"""
+    if numpy.isnan(llh):
+        return False
+    return numpy.isnan(best_llh) or llh < best_llh
+
+
 class FindBestRecoResultForPixel(icetray.I3Module):
+    """
+    Pushes the best frame of each pixel once all its position variations
+    have arrived. Pixels are told apart by event too, so frames of
+    several events can be mixed.
+
+    By default all the frames of a pixel are held until then. With
+    RunningBest, only the best frame so far, its LLH and a bitmask of the
+    position variations seen are kept per pixel, and repeated variations
+    are dropped instead of being counted twice.
+
+    A frame from `give_up_frame` pushes the best frame so far of a pixel
+    that will not get all its position variations.
+    """
     def __init__(self, ctx):
         super(FindBestRecoResultForPixel, self).__init__(ctx)
         self.AddOutBox("OutBox")
         self.AddParameter("NPosVar", "Number of position variations to collect", 7)
+        self.AddParameter("RunningBest", "Keep only the best frame so far for each pixel", False)
 
     def Configure(self):
         self.NPosVar = self.GetParameter("NPosVar")
+        self.RunningBest = self.GetParameter("RunningBest")
 
         self.pixelNumToFramesMap = {}
+        self.pixelBest = {} # (run_id,event_id,nside,pixel) -> [best frame, best llh, bitmask of position variations]
 
     def Physics(self, frame):
         if "SCAN_HealpixNSide" not in frame:
             raise RuntimeError("SCAN_HealpixNSide not in frame")
         if "SCAN_HealpixPixel" not in frame:
             raise RuntimeError("SCAN_HealpixPixel not in frame")
+        if GIVE_UP_PIXEL in frame:
+            self.GiveUp(pixel_key(frame))
+            return
         if "SCAN_PositionVariationIndex" not in frame:
             raise RuntimeError("SCAN_PositionVariationIndex not in frame")
 
-        nside = frame["SCAN_HealpixNSide"].value
-        pixel = frame["SCAN_HealpixPixel"].value
-        index = (nside,pixel)
+        index = pixel_key(frame)
         posVarIndex = frame["SCAN_PositionVariationIndex"].value
 
+        if self.RunningBest:
+            self.UpdateBest(index, posVarIndex, frame)
+            return
+
         if index not in self.pixelNumToFramesMap:
             self.pixelNumToFramesMap[index] = []
         self.pixelNumToFramesMap[index].append(frame)
@@ -75,7 +132,48 @@ class FindBestRecoResultForPixel(icetray.I3Module):
 
             del self.pixelNumToFramesMap[index]
 
+    def UpdateBest(self, index, posVarIndex, frame):
+        if index not in self.pixelBest:
+            self.pixelBest[index] = [None, numpy.nan, 0]
+        best = self.pixelBest[index]
+
+        bit = 1 << posVarIndex
+        if best[2] & bit:
+            print("duplicate position variation", posVarIndex, "for pixel", index, "- ignoring it")
+            return
+        best[2] |= bit
+
+        thisLLH = frame_llh(frame)
+        if (best[0] is None) or better_llh(thisLLH, best[1]):
+            best[0] = frame
+            best[1] = thisLLH
+
+        if bin(best[2]).count("1") >= self.NPosVar:
+            print("all scans arrived for pixel", index, "best LLH is", best[1])
+            self.PushFrame(best[0])
+            del self.pixelBest[index]
+
+    def GiveUp(self, index):
+        if index in self.pixelBest:
+            best = self.pixelBest.pop(index)
+            print("giving up on pixel", index, "position variations seen:", bin(best[2]), "best LLH is", best[1])
+            self.PushFrame(best[0])
+        elif index in self.pixelNumToFramesMap:
+            frames = self.pixelNumToFramesMap.pop(index)
+            bestFrame = frames[0]
+            for frame in frames[1:]:
+                if better_llh(frame_llh(frame), frame_llh(bestFrame)):
+                    bestFrame = frame
+            print("giving up on pixel", index, "with", len(frames), "position variations, best LLH is", frame_llh(bestFrame))
+            self.PushFrame(bestFrame)
+
     def Finish(self):
+        if self.pixelBest:
+            print("**** WARN ****  --  pixels left in cache, not all of the packets seem to be complete")
+            for index in sorted(self.pixelBest):
+                print(index, "position variations seen:", bin(self.pixelBest[index][2]))
+            print("**** WARN ****  --  END")
+
         if len(self.pixelNumToFramesMap) == 0:
             return
 
@@ -149,15 +247,21 @@ def get_reco_losses_inside(p_frame):
 class CollectRecoResults(icetray.I3Module):
     def __init__(self, ctx):
         super(CollectRecoResults, self).__init__(ctx)
-        self.AddParameter("event_id", "The event_id", None)
+        self.AddParameter("event_id", "The event_id, or None to take it from each frame", None)
         self.AddParameter("output_dir", "The output_dir", None)
+        self.AddParameter("write_index", "Also add each result to the index of its event", True)
+        self.AddParameter("index_chunk", "Index rows buffered before a chunk is written", 64)
+        self.AddParameter("index_writers", "Dict of the IndexWriter of each event, for the caller to flush", None)
         self.AddOutBox("OutBox")
 
     def Configure(self):
         self.event_id = self.GetParameter("event_id")
         self.cache_dir = self.GetParameter("output_dir")
-
-        self.this_event_cache_dir = os.path.join(self.cache_dir, self.event_id)
+        self.write_index = self.GetParameter("write_index")
+        self.index_chunk = self.GetParameter("index_chunk")
+        self.index_writers = self.GetParameter("index_writers")
+        if self.index_writers is None:
+            self.index_writers = {}
 
     def Physics(self, frame):
         if "SCAN_HealpixNSide" not in frame:
@@ -179,21 +283,39 @@ class CollectRecoResults(icetray.I3Module):
             llh = frame["MillipedeStarting2ndPass_millipedellh"].logl
 
         # compute and retrieve losses
+        start = time.time()
         get_reco_losses_inside(frame)
+        add_stage_time(frame, "losses", time.time()-start)
         recoLossesInside = frame["MillipedeStarting2ndPass_totalRecoLossesInside"].value
         recoLossesTotal = frame["MillipedeStarting2ndPass_totalRecoLossesTotal"].value
 
 
         # save this frame to the disk
 
-        nside_dir = os.path.join(self.this_event_cache_dir, "nside{0:06d}".format(nside))
+        # without a fixed event_id, follow the events as they come
+        event_id = self.event_id
+        if event_id is None:
+            event_id = str(frame["I3EventHeader"].event_id)
+        this_event_cache_dir = os.path.join(self.cache_dir, event_id)
+        nside_dir = os.path.join(this_event_cache_dir, "nside{0:06d}".format(nside))
         if not os.path.exists(nside_dir):
             os.system("mkdir -p %s"%nside_dir)
         pixel_file_name = os.path.join(nside_dir, "pix{0:012d}.i3".format(pixel))
 
         print(" - saving pixel file {0}...".format(pixel_file_name))
+        start = time.time()
         save_GCD_frame_packet_to_file([frame], pixel_file_name)
+        if self.write_index:
+            if this_event_cache_dir not in self.index_writers:
+                self.index_writers[this_event_cache_dir] = IndexWriter(this_event_cache_dir, self.index_chunk)
+            self.index_writers[this_event_cache_dir].append(frame_row(frame))
+        # only in the frame passed on, the saved one is already written
+        add_stage_time(frame, "write", time.time()-start)
 
         self.PushFrame(frame)
 
+    def Finish(self):
+        for writer in self.index_writers.values():
+            writer.flush()
+
 
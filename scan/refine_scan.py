@@ -0,0 +1,159 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+import numpy
+import healpy
+
+
+def child_pixels(nside, pixel, child_nside):
+    """The (ring ordered) pixels at `child_nside` inside a pixel at `nside`"""
+    if child_nside % nside != 0:
+        raise RuntimeError("nside {0} does not refine nside {1}".format(child_nside, nside))
+    ratio = (child_nside // nside)**2
+    nest = healpy.ring2nest(nside, pixel)
+    children = numpy.arange(nest*ratio, (nest+1)*ratio)
+    return [int(p) for p in healpy.nest2ring(child_nside, children)]
+
+
+class RefinementScheduler(object):
+    """
+    Pick the pixels for each level of an adaptive multi-resolution scan.
+
+    The first level covers the whole sky at the coarsest nside. Each later
+    level only scans the children of the `n_best` best pixels of the level
+    before it. Results are fed in as they arrive with `add_frame`.
+    """
+    def __init__(self, nsides=(8, 64, 512), n_best=12, npos=7, event_header=None):
+        self.nsides = [int(n) for n in nsides]
+        if self.nsides != sorted(self.nsides):
+            raise RuntimeError("refinement levels must have increasing nside")
+        self.n_best = n_best
+        self.npos = npos
+        self.event_header = event_header
+
+        self.level = None
+        self.pixels = []
+        self.results = {} # (nside,pixel) -> {posvar: llh}
+        self.vertices = {} # (nside,pixel) -> (llh, position, time) of the best fit
+        self.first_pass_llh = numpy.nan # best 1st pass LLH of the event
+
+    @property
+    def nside(self):
+        return self.nsides[self.level]
+
+    def next_level(self):
+        """Move on to the next level, returning its pixels or None when done"""
+        if self.level is None:
+            self.level = 0
+            self.pixels = list(range(healpy.nside2npix(self.nside)))
+            return self.pixels
+
+        if self.level+1 >= len(self.nsides):
+            return None
+        best = self.best_pixels(self.nside, self.n_best)
+        self.level += 1
+        pixels = set()
+        for pixel in best:
+            pixels.update(child_pixels(self.nsides[self.level-1], pixel, self.nside))
+        self.pixels = sorted(pixels)
+        return self.pixels
+
+    def add_frame(self, frame):
+        """Record the result in a reconstructed P-frame"""
+        if self.event_header is not None:
+            header = frame["I3EventHeader"]
+            if (header.run_id, header.event_id) != (self.event_header.run_id, self.event_header.event_id):
+                print("ignoring result for another event", header.run_id, header.event_id)
+                return
+        if "MillipedeStarting2ndPass_millipedellh" in frame:
+            llh = frame["MillipedeStarting2ndPass_millipedellh"].logl
+        else:
+            llh = numpy.nan
+        if "MillipedeStarting1stPass_millipedellh" in frame:
+            first = frame["MillipedeStarting1stPass_millipedellh"].logl
+            if not numpy.isnan(first):
+                self.first_pass_llh = numpy.nanmin([self.first_pass_llh, first])
+        nside = frame["SCAN_HealpixNSide"].value
+        pixel = frame["SCAN_HealpixPixel"].value
+        self.add_result(nside, pixel, frame["SCAN_PositionVariationIndex"].value, llh)
+        if "MillipedeStarting2ndPass" in frame and not numpy.isnan(llh):
+            fit = frame["MillipedeStarting2ndPass"]
+            self.add_vertex(nside, pixel, llh, fit.pos, fit.time)
+
+    def add_result(self, nside, pixel, posvar, llh):
+        index = (nside,pixel)
+        if index not in self.results:
+            self.results[index] = {}
+        self.results[index][posvar] = llh
+
+    def add_failed(self, nside, pixel, posvar):
+        """Count a position variation that will never have a result as done"""
+        if posvar not in self.results.get((nside,pixel), {}):
+            self.add_result(nside, pixel, posvar, numpy.nan)
+
+    def add_vertex(self, nside, pixel, llh, pos, time):
+        index = (nside,pixel)
+        if index not in self.vertices or llh < self.vertices[index][0]:
+            self.vertices[index] = (llh, pos, time)
+
+    def warm_seed(self, nside, pixel):
+        """
+        Best-fit (position, time) of the enclosing pixel and its
+        neighbours at the closest coarser level with results, or None.
+        A level is sent before any of its own results arrive, so its
+        seeds can only come from the levels before it.
+        """
+        theta, phi = healpy.pix2ang(nside, pixel)
+        for ns in sorted(set(self.nsides), reverse=True):
+            if ns >= nside:
+                continue
+            candidates = [int(healpy.ang2pix(ns, theta, phi))]
+            candidates += [int(p) for p in healpy.get_all_neighbours(ns, theta, phi) if p >= 0]
+            found = [self.vertices[(ns,p)] for p in candidates if (ns,p) in self.vertices]
+            if found:
+                llh, pos, time = min(found, key=lambda v: v[0])
+                return pos, time
+        return None
+
+    def warm_seeds(self, nside, pixels):
+        """Warm seeds for the pixels that have one, as {pixel: (position, time)}"""
+        seeds = {}
+        for pixel in pixels:
+            seed = self.warm_seed(nside, pixel)
+            if seed is not None:
+                seeds[pixel] = seed
+        return seeds
+
+    def pixel_llh(self, nside, pixel):
+        """Best LLH over the position variations seen for a pixel"""
+        llhs = [l for l in self.results.get((nside,pixel), {}).values() if not numpy.isnan(l)]
+        if not llhs:
+            return numpy.nan
+        return min(llhs)
+
+    def best_1st_pass_llh(self):
+        """
+        Best 1st pass LLH over all the results so far, or None. It is the
+        one to compare other 1st pass LLHs with, as the 2nd pass fits with
+        finer steps and a free time and so always comes out lower.
+        """
+        if numpy.isnan(self.first_pass_llh):
+            return None
+        return float(self.first_pass_llh)
+
+    def level_done(self):
+        """Have all position variations arrived or failed for every pixel of this level?"""
+        for pixel in self.pixels:
+            if len(self.results.get((self.nside,pixel), {})) < self.npos:
+                return False
+        return True
+
+    def best_pixels(self, nside, n):
+        """The `n` pixels at `nside` with the lowest LLH"""
+        llhs = []
+        for (ns,pixel) in self.results:
+            if ns != nside: continue
+            llh = self.pixel_llh(ns, pixel)
+            if not numpy.isnan(llh):
+                llhs.append((llh, pixel))
+        return [pixel for llh,pixel in sorted(llhs)[:n]]
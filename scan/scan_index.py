@@ -0,0 +1,127 @@
+"""
+Compact index of the scan results of an event.
+
+One row per reconstructed frame, with the scalars that consolidation and
+skymaps need, kept in the `index` directory of the event. Each writer
+process appends raw rows to a file of its own, so no locking is needed and
+an event has one file per process, and readers just concatenate them.
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import glob
+import socket
+import numpy
+
+INDEX_DTYPE = numpy.dtype([
+    ('nside', numpy.int32),
+    ('pixel', numpy.int64),
+    ('posvar', numpy.int16),
+    ('llh', numpy.float64),
+    ('losses_inside', numpy.float64),
+    ('losses_total', numpy.float64),
+    ('x', numpy.float64),
+    ('y', numpy.float64),
+    ('z', numpy.float64),
+    ('time', numpy.float64),
+    ('zenith', numpy.float64),
+    ('azimuth', numpy.float64),
+])
+
+
+def index_dir(event_dir):
+    return os.path.join(event_dir, "index")
+
+def frame_row(frame):
+    """The index row for a reconstructed P-frame"""
+    row = numpy.zeros(1, dtype=INDEX_DTYPE)[0]
+    row['nside'] = frame["SCAN_HealpixNSide"].value
+    row['pixel'] = frame["SCAN_HealpixPixel"].value
+    row['posvar'] = frame["SCAN_PositionVariationIndex"].value
+    if "MillipedeStarting2ndPass_millipedellh" in frame:
+        row['llh'] = frame["MillipedeStarting2ndPass_millipedellh"].logl
+    else:
+        row['llh'] = numpy.nan
+    for name, key in (('losses_inside', "MillipedeStarting2ndPass_totalRecoLossesInside"),
+                      ('losses_total', "MillipedeStarting2ndPass_totalRecoLossesTotal")):
+        row[name] = frame[key].value if key in frame else numpy.nan
+    particle = frame["MillipedeStarting2ndPass"]
+    row['x'] = particle.pos.x
+    row['y'] = particle.pos.y
+    row['z'] = particle.pos.z
+    row['time'] = particle.time
+    row['zenith'] = particle.dir.zenith
+    row['azimuth'] = particle.dir.azimuth
+    return row
+
+
+class IndexWriter(object):
+    """
+    Buffers index rows for an event and appends them, `chunk_size` at a
+    time or on `flush`, to the row file of this process
+    """
+    def __init__(self, event_dir, chunk_size=64):
+        self.dir = index_dir(event_dir)
+        self.chunk_size = chunk_size
+        self.rows = []
+        self.filename = os.path.join(self.dir, "{0}-{1}.rows".format(socket.gethostname(), os.getpid()))
+
+    def append(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        with open(self.filename, 'ab') as f:
+            # drop a partial row left by a process killed while writing
+            size = os.fstat(f.fileno()).st_size
+            if size % INDEX_DTYPE.itemsize:
+                f.truncate(size - size % INDEX_DTYPE.itemsize)
+            f.write(numpy.array(self.rows, dtype=INDEX_DTYPE).tobytes())
+        self.rows = []
+
+
+def read_rows(filename):
+    """The whole rows in a row file, which may be being appended to"""
+    count = os.path.getsize(filename) // INDEX_DTYPE.itemsize
+    return numpy.fromfile(filename, dtype=INDEX_DTYPE, count=count)
+
+
+def read_index(event_dir):
+    """All the index rows of an event, as one structured array"""
+    chunks = [read_rows(f) for f in sorted(glob.glob(os.path.join(index_dir(event_dir), "*.rows")))]
+    # chunks written before the row files
+    chunks += [numpy.load(f) for f in sorted(glob.glob(os.path.join(index_dir(event_dir), "*.npy")))]
+    if not chunks:
+        return numpy.zeros(0, dtype=INDEX_DTYPE)
+    return numpy.concatenate(chunks)
+
+def best_per_pixel(index):
+    """
+    The row with the best LLH for each (nside, pixel), and the number of
+    distinct position variations seen for it. Rows without an LLH only
+    win for pixels that have nothing else.
+    """
+    if len(index) == 0:
+        return index, numpy.zeros(0, dtype=int)
+    llh = numpy.where(numpy.isnan(index['llh']), numpy.inf, index['llh'])
+    # sort by pixel, then llh, so the first row of each pixel is its best
+    order = numpy.lexsort((llh, index['pixel'], index['nside']))
+    rows = index[order]
+    new_pixel = numpy.ones(len(rows), dtype=bool)
+    new_pixel[1:] = (rows['nside'][1:] != rows['nside'][:-1]) | (rows['pixel'][1:] != rows['pixel'][:-1])
+    starts = numpy.flatnonzero(new_pixel)
+
+    # distinct position variations per pixel
+    keys = numpy.stack([rows['nside'].astype(numpy.int64), rows['pixel'], rows['posvar'].astype(numpy.int64)], axis=1)
+    distinct = numpy.unique(keys, axis=0)
+    pixel_keys = distinct[:, :2]
+    boundaries = numpy.ones(len(pixel_keys), dtype=bool)
+    boundaries[1:] = numpy.any(pixel_keys[1:] != pixel_keys[:-1], axis=1)
+    counts = numpy.diff(numpy.append(numpy.flatnonzero(boundaries), len(pixel_keys)))
+    return rows[starts], counts
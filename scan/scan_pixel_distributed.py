@@ -2,7 +2,16 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 import os
+import time
 import datetime
+import logging
+import threading
+import collections
+import hashlib
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import numpy as np
 import healpy
 
@@ -12,6 +21,8 @@ from icecube import photonics_service, gulliver, gulliver_modules, millipede
 from icecube import frame_object_diff
 from icecube.frame_object_diff.segments import uncompress
 from consolidate_scan import CollectRecoResults
+from scan_utils import hash_frame_packet
+from stage_timing import STAGE_TIMES, StageClock, add_stage_time
 
 
 
@@ -42,58 +53,142 @@ class FrameReader(icetray.I3Module):
         self.fr = frames
     def Process(self):
         if self.fr:
-	    f1 = self.fr.pop(0)
-	    print("Now Pushing the %s frame" % f1.Stop)
+            # push a shallow copy, the frames may be a packet cached by the
+            # Sink and shared with later messages
+            f1 = icetray.I3Frame(self.fr.pop(0))
+            print("Now Pushing the %s frame" % f1.Stop)
             self.PushFrame(f1)
         else:
             self.RequestSuspension()
 
+class QueueReader(icetray.I3Module):
+    """
+    Driving module that pushes frame packets as they arrive on a queue.
 
+    Blocks waiting for the next packet, and ends the stream on `None`.
+    """
+    def __init__(self, context):
+        icetray.I3Module.__init__(self, context)
+        self.AddParameter('queue', 'queue of input frame packets', None)
+        self.queue = None
+    def Configure(self):
+        self.queue = self.GetParameter('queue')
+    def Process(self):
+        frames = self.queue.get()
+        if frames is None:
+            self.RequestSuspension()
+            return
+        for fr in frames:
+            # shallow copy, as in FrameReader
+            self.PushFrame(icetray.I3Frame(fr))
 
-#def scan_pixel_distributed_client(frame,pulsesName="SplitUncleanedInIcePulsesLatePulseCleaned"):
-def scan_pixel_distributed_client(frame,pulsesName,output,baseline):
-    event_id_string = str(frame[-1]['I3EventHeader'].event_id)
-    base_GCD_path = baseline
+class QueueWriter(icetray.I3Module):
+    """Puts each finished Physics frame on a queue"""
+    def __init__(self, context):
+        icetray.I3Module.__init__(self, context)
+        self.AddParameter('queue', 'queue of output frames', None)
+        self.queue = None
+    def Configure(self):
+        self.queue = self.GetParameter('queue')
+    def Physics(self, frame):
+        self.queue.put(frame)
+        self.PushFrame(frame)
+
+class LLHGapCheck(icetray.I3Module):
+    """
+    Marks pixels whose 1st pass is already `gap` worse than the best 1st
+    pass LLH of their event as coarse-only, so the 2nd pass can be skipped.
+
+    The best is the lowest of the SCAN_EventBest1stPassLLH that the
+    producer sends with each pixel and the 1st pass LLHs seen here, so
+    1st pass LLHs are only ever compared with each other. Coarse-only
+    pixels get the 1st pass results under the 2nd pass names.
+    """
+    def __init__(self, context):
+        icetray.I3Module.__init__(self, context)
+        self.AddParameter('gap', 'LLH difference to the best pixel beyond which the 2nd pass is skipped', None)
+        self.AddOutBox("OutBox")
+    def Configure(self):
+        self.gap = self.GetParameter('gap')
+        self.best = {}
+    def Physics(self, frame):
+        if "MillipedeStarting1stPass_millipedellh" not in frame:
+            self.PushFrame(frame)
+            return
+        llh = frame["MillipedeStarting1stPass_millipedellh"].logl
+        header = frame["I3EventHeader"]
+        event = (header.run_id, header.event_id)
+        best = self.best.get(event, np.nan)
+        if "SCAN_EventBest1stPassLLH" in frame:
+            best = np.nanmin([best, frame["SCAN_EventBest1stPassLLH"].value])
+        if not np.isnan(llh):
+            self.best[event] = np.nanmin([best, llh])
+
+        if not np.isnan(best) and llh-best > self.gap:
+            print("1st pass LLH {0} is more than {1} above the best {2}, skipping the 2nd pass".format(llh, self.gap, best))
+            frame["SCAN_CoarseOnly"] = icetray.I3Bool(True)
+            for suffix in ["", "_millipedellh", "Params"]:
+                if "MillipedeStarting1stPass"+suffix in frame:
+                    frame["MillipedeStarting2ndPass"+suffix] = frame["MillipedeStarting1stPass"+suffix]
+        self.PushFrame(frame)
+
+def load_cascade_service():
     # At HESE energies, deposited light is dominated by the stochastic losses
     # (muon part emits so little light in comparison)
     # This is why we can use ems_mie instead of InfBareMu_mie even for tracks
     base = os.path.expandvars('$I3_DATA/photon-tables/splines/ems_mie_z20_a10.%s.fits')
-    cascade_service = photonics_service.I3PhotoSplineService(base % "abs", base % "prob", 0)
+    return photonics_service.I3PhotoSplineService(base % "abs", base % "prob", 0)
 
-    basemu = os.path.expandvars('$I3_DATA/photon-tables/splines/InfBareMu_mie_%s_z20a10_V2.fits')
-    # muon_service = photonics_service.I3PhotoSplineService(basemu % "abs", basemu% "prob", 0)
-    muon_service = None
 
-    iceModelBaseNames = {"SpiceMie": "ems_mie_z20_a10", "Spice1": "ems_spice1_z20_a10"}
-    iceModelBaseName = iceModelBaseNames["SpiceMie"]
+class FrameCollector(icetray.I3Module):
+    """Appends every frame to a list"""
+    def __init__(self, context):
+        icetray.I3Module.__init__(self, context)
+        self.AddParameter('frames', 'output frames', None)
+    def Configure(self):
+        self.frames = self.GetParameter('frames')
+    def Process(self):
+        fr = self.PopFrame()
+        self.frames.append(fr)
+        self.PushFrame(fr)
 
-    SPEScale = 0.99
-    print(len(frame))
-    ########## the tray
+def uncompress_gcd(frames, baseline):
+    """Patch compressed G/C/D frames against the baseline GCD"""
+    out_frames = []
     tray = I3Tray()
-    tray.Add(FrameReader, frames=frame)
-#    ########## perform the fit
-    def notifyStart(frame):
-        print("got data - uncompressing GCD", datetime.datetime.now())
-    tray.AddModule(notifyStart, "notifyStart")
-
+    tray.Add(FrameReader, frames=list(frames))
     tray.Add(uncompress, "GCD_patch",
          keep_compressed=False,
-         base_path=base_GCD_path)
+         base_path=baseline)
+    tray.Add(FrameCollector, frames=out_frames)
+    tray.Execute()
+    tray.Finish()
+    del tray
+    return out_frames
+
+# HighEnergyExclusions parameters, each naming an exclusion object it makes
+HIGH_ENERGY_EXCLUSIONS = [
+    ('ExcludeDeepCore', 'DeepCoreDOMs'),
+    ('ExcludeSaturatedDOMs', 'SaturatedDOMs'),
+    ('ExcludeBrightDOMs', 'BrightDOMs'),
+    ('BadDomsList', 'BadDomsList'),
+    ('CalibrationErrata', 'CalibrationErrata'),
+    ('SaturationWindows', 'SaturationWindows'),
+]
 
-    def notifyExclusions(frame):
-        print("determining DOM exclusions for this event", datetime.datetime.now())
-    tray.AddModule(notifyExclusions, "notifyExclusions")
-    
-    ExcludedDOMs = \
+def excluded_dom_names(pulsesName):
+    """The names of the exclusion objects DOMExclusions makes"""
+    return [name for param, name in HIGH_ENERGY_EXCLUSIONS] + [pulsesName+'LatePulseCleanedTimeWindows']
+
+@icetray.traysegment
+def DOMExclusions(tray, name, pulsesName):
+    """
+    Find the DOMs and time windows Millipede should leave out, returning
+    the names of the exclusion objects.
+    """
     tray.AddSegment(millipede.HighEnergyExclusions, 'millipede_DOM_exclusions',
         Pulses = pulsesName,
-        ExcludeDeepCore='DeepCoreDOMs',
-        ExcludeSaturatedDOMs='SaturatedDOMs',
-        ExcludeBrightDOMs='BrightDOMs',
-        BadDomsList='BadDomsList',
-        CalibrationErrata='CalibrationErrata',
-        SaturationWindows='SaturationWindows'
+        **dict(HIGH_ENERGY_EXCLUSIONS)
         )
    # # I like having frame objects in there even if they are empty for some frames
     def createEmptyDOMLists(frame, ListNames=[]):
@@ -105,12 +200,209 @@ def scan_pixel_distributed_client(frame,pulsesName,output,baseline):
         ListNames = ["BrightDOMs"],
         Streams=[icetray.I3Frame.Physics])
 
-    # add the late pulse exclusion windows
-    ExcludedDOMs = ExcludedDOMs + [pulsesName+'LatePulseCleanedTimeWindows']
+    # with the late pulse exclusion windows
+    return excluded_dom_names(pulsesName)
+
+def prepare_event(frames, baseline, pulsesName):
+    """
+    Uncompress the GCD of a frame packet and find its DOM exclusions.
+
+    Returns the uncompressed G/C/D/Q frames, a P-frame holding only the
+    exclusion objects, to be copied into each pixel's P-frame, and the
+    seconds each of the two steps took.
+    """
+    packet = [fr for fr in frames if fr.Stop != icetray.I3Frame.Physics]
+    p_frame = None
+    for fr in frames:
+        if fr.Stop == icetray.I3Frame.Physics:
+            p_frame = icetray.I3Frame(fr)
+            break
+    if p_frame is None:
+        start = time.time()
+        return uncompress_gcd(packet, baseline), None, {"gcd_uncompress": time.time()-start}
+    keys_before = set(p_frame.keys())
+
+    out_frames = []
+    clock = StageClock()
+    tray = I3Tray()
+    tray.Add(FrameReader, frames=packet+[p_frame])
+    tray.Add(uncompress, "GCD_patch",
+         keep_compressed=False,
+         base_path=baseline)
+    tray.AddModule(clock.mark, "time_gcd_uncompress", stage="gcd_uncompress",
+        Streams=[icetray.I3Frame.Physics])
+    tray.AddSegment(DOMExclusions, "DOMExclusions", pulsesName=pulsesName)
+    tray.AddModule(clock.mark, "time_dom_exclusions", stage="dom_exclusions",
+        Streams=[icetray.I3Frame.Physics])
+    tray.Add(FrameCollector, frames=out_frames)
+    clock.start(None)
+    tray.Execute()
+    tray.Finish()
+    del tray
+
+    exclusions = icetray.I3Frame(icetray.I3Frame.Physics)
+    times = {}
+    for fr in out_frames:
+        if fr.Stop != icetray.I3Frame.Physics:
+            continue
+        times = dict(fr[STAGE_TIMES])
+        for key in fr.keys():
+            if key in keys_before or key == STAGE_TIMES:
+                continue
+            if fr.get_stop(key) == icetray.I3Frame.Physics:
+                exclusions[key] = fr[key]
+    return [fr for fr in out_frames if fr.Stop != icetray.I3Frame.Physics], exclusions, times
+
+class EventCache(object):
+    """
+    Uncompressed G/C/D/Q frames and DOM exclusions of recent events.
+
+    Keyed by the hash of the frame packet plus the baseline GCD directory,
+    using the hash the packet was stored under when there is one, and
+    evicting the least recently used event once more than `size` are
+    held. With `cache_dir`, the entries are also kept on disk for later
+    processes.
+    """
+    def __init__(self, baseline, pulsesName, size=4, cache_dir=None):
+        self.baseline = baseline
+        self.pulsesName = pulsesName
+        self.size = size
+        self.cache_dir = cache_dir
+        self.baseline_key = hashlib.sha1(os.path.abspath(baseline).encode('utf-8')).hexdigest()[:12]
+        self.entries = collections.OrderedDict()
+
+    def key(self, packet, packet_hash=None):
+        if packet_hash is None:
+            # sent inline, so hash the frames themselves
+            packet_hash = hash_frame_packet(packet)
+        return packet_hash+'_'+self.baseline_key
+
+    def get(self, frames, packet_hash=None):
+        """The cache entry for an event, and the time spent preparing it"""
+        packet = [fr for fr in frames if fr.Stop != icetray.I3Frame.Physics]
+        key = self.key(packet, packet_hash)
+        times = {"gcd_uncompress": 0., "dom_exclusions": 0.}
+        if key in self.entries:
+            # most recently used goes last
+            entry = self.entries.pop(key)
+        else:
+            start = time.time()
+            entry = self.load(key)
+            if entry is None:
+                print("uncompressing GCD and determining DOM exclusions for this event", datetime.datetime.now())
+                packet, exclusions, times = prepare_event(frames, self.baseline, self.pulsesName)
+                entry = (packet, exclusions)
+                self.save(key, entry)
+            else:
+                times["gcd_uncompress"] = time.time()-start
+        self.entries[key] = entry
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return entry, times
+
+    def load(self, key):
+        if not self.cache_dir:
+            return None
+        filename = os.path.join(self.cache_dir, key+'.i3')
+        if not os.path.exists(filename):
+            return None
+        frames = [fr for fr in dataio.I3File(filename)]
+        exclusions = None
+        if frames and frames[-1].Stop == icetray.I3Frame.Physics:
+            exclusions = frames.pop()
+        return frames, exclusions
+
+    def save(self, key, entry):
+        if not self.cache_dir:
+            return
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        frames, exclusions = entry
+        filename = os.path.join(self.cache_dir, key+'.i3')
+        # write then rename, other consumers may be reading the cache
+        tmpname = filename+'.tmp{}'.format(os.getpid())
+        i3f = dataio.I3File(tmpname, 'w')
+        for fr in frames:
+            i3f.push(fr)
+        if exclusions is not None:
+            i3f.push(exclusions)
+        i3f.close()
+        os.rename(tmpname, filename)
+
+    def prepare(self, frames, packet_hash=None):
+        """
+        Swap the frame packet for the cached uncompressed one, and copy
+        the event's DOM exclusions into each P-frame. The time spent on
+        that is shared out between the P-frames, in their SCAN_StageTimes.
+        """
+        (packet, exclusions), times = self.get(frames, packet_hash)
+        in_frames = [fr for fr in frames if fr.Stop == icetray.I3Frame.Physics]
+        p_frames = []
+        for fr in in_frames:
+            fr = icetray.I3Frame(fr)
+            if exclusions is not None:
+                for key in exclusions.keys():
+                    if key not in fr:
+                        fr[key] = exclusions[key]
+            for stage in times:
+                add_stage_time(fr, stage, times[stage]/len(in_frames))
+            p_frames.append(fr)
+        return packet+p_frames
+
+
+@icetray.traysegment
+def MillipedePixelScan(tray, name, pulsesName, output, baseline,
+                       cascade_service, muon_service=None, event_id=None,
+                       uncompress_gcd=True, dom_exclusions=True, warm_seed=False,
+                       llh_gap=None, index_writers=None):
+    """
+    Uncompress the GCD, find DOM exclusions and run the two Millipede passes,
+    then write the results for each pixel. Without `uncompress_gcd`, the
+    G/C/D frames must already be uncompressed, and without `dom_exclusions`
+    the P-frames must already hold the exclusion objects. With `warm_seed`,
+    the 1st pass starts from MillipedeWarmSeedParticle instead of
+    MillipedeSeedParticle where a frame has one. With `llh_gap`, pixels whose
+    1st pass is that far above the best LLH of the event skip the 2nd pass.
+    `index_writers` is passed on to CollectRecoResults, for a persistent
+    tray to flush the result index of each event.
+    """
+    base_GCD_path = baseline
+
+    basemu = os.path.expandvars('$I3_DATA/photon-tables/splines/InfBareMu_mie_%s_z20a10_V2.fits')
+    # muon_service = photonics_service.I3PhotoSplineService(basemu % "abs", basemu% "prob", 0)
+
+    iceModelBaseNames = {"SpiceMie": "ems_mie_z20_a10", "Spice1": "ems_spice1_z20_a10"}
+    iceModelBaseName = iceModelBaseNames["SpiceMie"]
+
+    SPEScale = 0.99
+
+#    ########## perform the fit
+    def notifyStart(frame):
+        print("got data - uncompressing GCD", datetime.datetime.now())
+    tray.AddModule(notifyStart, "notifyStart")
+
+    if uncompress_gcd:
+        tray.Add(uncompress, "GCD_patch",
+             keep_compressed=False,
+             base_path=base_GCD_path)
+
+    if dom_exclusions:
+        def notifyExclusions(frame):
+            print("determining DOM exclusions for this event", datetime.datetime.now())
+        tray.AddModule(notifyExclusions, "notifyExclusions")
+        ExcludedDOMs = tray.AddSegment(DOMExclusions, "DOMExclusions", pulsesName=pulsesName)
+    else:
+        ExcludedDOMs = excluded_dom_names(pulsesName)
+
     def notify0(frame):
         print("starting a new fit!", datetime.datetime.now())
     tray.AddModule(notify0, "notify0")
 
+    # per pixel stage times, in SCAN_StageTimes
+    clock = StageClock()
+    tray.AddModule(clock.start, "stage_clock",
+        Streams=[icetray.I3Frame.Physics])
+
     tray.AddService('MillipedeLikelihoodFactory', 'millipedellh',
         MuonPhotonicsService=muon_service,
         CascadePhotonicsService=cascade_service,
@@ -137,8 +429,20 @@ def scan_pixel_distributed_client(frame,pulsesName,output,baseline):
         StepZenith = 0.,
         StepAzimuth = 0.,
         )
+    seed = 'MillipedeSeedParticle'
+    if warm_seed:
+        # one simplex run per seed, so a warm seed replaces the default
+        # one rather than adding a second fit
+        def chooseSeed(frame):
+            name = 'MillipedeWarmSeedParticle'
+            if name not in frame:
+                name = 'MillipedeSeedParticle'
+            frame['MillipedeFirstPassSeed'] = frame[name]
+        tray.AddModule(chooseSeed, "chooseSeed",
+            Streams=[icetray.I3Frame.Physics])
+        seed = 'MillipedeFirstPassSeed'
     tray.AddService('I3BasicSeedServiceFactory', 'vetoseed',
-        FirstGuesses=['MillipedeSeedParticle'],
+        FirstGuesses=[seed],
         TimeShiftType='TNone',
         PositionShiftType='None')
     tray.AddModule('I3SimpleFitter', 'MillipedeStarting1stPass',
@@ -153,6 +457,11 @@ def scan_pixel_distributed_client(frame,pulsesName,output,baseline):
         print("1st pass done!", datetime.datetime.now())
         print("MillipedeStarting1stPass", frame["MillipedeStarting1stPass"])
     tray.AddModule(notify1, "notify1")
+    tray.AddModule(clock.mark, "time_1st_pass", stage="1st_pass",
+        Streams=[icetray.I3Frame.Physics])
+
+    if llh_gap is not None:
+        tray.AddModule(LLHGapCheck, "LLHGapCheck", gap=llh_gap)
 
     tray.AddService('MuMillipedeParametrizationFactory', 'fineSteps',
         MuonSpacing=0.*I3Units.m,
@@ -174,20 +483,152 @@ def scan_pixel_distributed_client(frame,pulsesName,output,baseline):
         SeedService='firstFitSeed',
         Parametrization='fineSteps',
         LogLikelihood='millipedellh',
-        Minimizer='simplex')
+        Minimizer='simplex',
+        If=lambda frame: "SCAN_CoarseOnly" not in frame)
 
 
     def notify2(frame):
         print("2nd pass done!", datetime.datetime.now())
         print("MillipedeStarting2ndPass", frame["MillipedeStarting2ndPass"])
     tray.AddModule(notify2, "notify2")
+    tray.AddModule(clock.mark, "time_2nd_pass", stage="2nd_pass",
+        Streams=[icetray.I3Frame.Physics])
     #Write Output files
     tray.AddModule(CollectRecoResults, "CollectRecoResults",
-        event_id = event_id_string,
-        output_dir = output
+        event_id = event_id,
+        output_dir = output,
+        index_writers = index_writers
     )
 
+
+#def scan_pixel_distributed_client(frame,pulsesName="SplitUncleanedInIcePulsesLatePulseCleaned"):
+def scan_pixel_distributed_client(frame,pulsesName,output,baseline,cascade_service=None):
+    """Scan one frame packet in a tray of its own"""
+    event_id_string = str(frame[-1]['I3EventHeader'].event_id)
+    if cascade_service is None:
+        cascade_service = load_cascade_service()
+
+    print(len(frame))
+    ########## the tray
+    tray = I3Tray()
+    tray.Add(FrameReader, frames=frame)
+    tray.AddSegment(MillipedePixelScan, "MillipedePixelScan",
+        pulsesName=pulsesName,
+        output=output,
+        baseline=baseline,
+        cascade_service=cascade_service,
+        event_id=event_id_string)
+
     print("Executing Tray")
     tray.Execute()
     tray.Finish()
     del tray
+
+
+class PixelScanEngine(object):
+    """
+    Persistent reconstruction for a consumer process.
+
+    The spline tables are loaded once, and the tray with the likelihood,
+    minimizer and fit modules is configured once and kept running on a
+    background thread. The uncompressed GCD and the DOM exclusions are
+    worked out once per event and cached. Each call feeds one frame packet
+    through the tray and waits for the reconstructed P-frames, up to
+    `fit_timeout` seconds for each. A tray that misses that is given up
+    on, and the next call starts a new one.
+    """
+    def __init__(self, pulsesName, output, baseline, event_cache_size=4, event_cache_dir=None,
+                 warm_seed=False, llh_gap=None, fit_timeout=3600):
+        self.pulsesName = pulsesName
+        self.fit_timeout = fit_timeout
+        self.warm_seed = warm_seed
+        self.llh_gap = llh_gap
+        self.output = output
+        self.baseline = baseline
+        self.event_cache = EventCache(baseline, pulsesName, size=event_cache_size,
+                                      cache_dir=event_cache_dir)
+        self.cascade_service = load_cascade_service()
+        self.muon_service = None
+        self.in_queue = None
+        self.out_queue = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.index_writers = {}
+
+    def start(self):
+        """Configure a new tray and start it running"""
+        self.in_queue = queue.Queue()
+        self.out_queue = queue.Queue()
+        tray = I3Tray()
+        tray.Add(QueueReader, queue=self.in_queue)
+        tray.AddSegment(MillipedePixelScan, "MillipedePixelScan",
+            pulsesName=self.pulsesName,
+            output=self.output,
+            baseline=self.baseline,
+            cascade_service=self.cascade_service,
+            muon_service=self.muon_service,
+            uncompress_gcd=False,
+            dom_exclusions=False,
+            warm_seed=self.warm_seed,
+            llh_gap=self.llh_gap,
+            index_writers=self.index_writers)
+        tray.Add(QueueWriter, queue=self.out_queue)
+        self.thread = threading.Thread(target=self._run, args=(tray, self.out_queue))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, tray, out_queue):
+        try:
+            tray.Execute()
+            tray.Finish()
+        except Exception as e:
+            logging.warning('reconstruction tray failed', exc_info=True)
+            out_queue.put(e)
+        else:
+            out_queue.put(None)
+
+    def __call__(self, frames, packet_hash=None):
+        """
+        Reconstruct one frame packet, which may hold a batch of P-frames,
+        returning the output P-frames. `packet_hash` is the hash the
+        packet was stored under, if it was.
+        """
+        nframes = len([fr for fr in frames if fr.Stop == icetray.I3Frame.Physics])
+        out_frames = []
+        with self.lock:
+            # with a warm cache, the packet goes straight to the fit
+            frames = self.event_cache.prepare(frames, packet_hash)
+            if not self.thread or not self.thread.is_alive():
+                # first call, or the last packet killed the tray
+                self.start()
+            self.in_queue.put(frames)
+            while len(out_frames) < nframes:
+                try:
+                    ret = self.out_queue.get(timeout=self.fit_timeout)
+                except queue.Empty:
+                    # a hung fit or a dropped frame, so fail the packet
+                    # for a retry rather than wait forever
+                    self.abandon()
+                    raise Exception('no reconstructed frame within {} s'.format(self.fit_timeout))
+                if isinstance(ret, Exception):
+                    raise ret
+                if ret is None:
+                    raise Exception('reconstruction tray stopped')
+                out_frames.append(ret)
+            # the tray only finishes at shutdown, so append the index rows
+            # of every packet as soon as its pixel files are written
+            for writer in self.index_writers.values():
+                writer.flush()
+        return out_frames
+
+    def abandon(self):
+        """Leave the running tray to stop once it can, for a new one to take over"""
+        logging.warning('giving up on the reconstruction tray')
+        self.in_queue.put(None)
+        self.thread = None
+
+    def close(self):
+        if self.thread and self.thread.is_alive():
+            self.in_queue.put(None)
+            self.thread.join()
+        self.thread = None
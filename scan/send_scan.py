@@ -25,17 +25,27 @@ class SendPixelsToScan(icetray.I3Module):
         super(SendPixelsToScan, self).__init__(ctx)
         self.AddParameter("FramePacket", "The GCDQp frame packet to send", None)
         self.AddParameter("NSide", "The healpix resolution in terms of \"nside\".", 8)
+        self.AddParameter("Pixels", "The pixels to scan, all of them if None", None)
         self.AddParameter("InputTimeName", "Name of an I3Double to use as the vertex time for the coarsest scan", "HESE_VHESelfVetoVertexTime")
         self.AddParameter("InputPosName", "Name of an I3Position to use as the vertex position for the coarsest scan", "HESE_VHESelfVetoVertexPos")
         self.AddParameter("OutputParticleName", "Name of the output I3Particle", "MillipedeSeedParticle")
+        self.AddParameter("SendPacketOnce", "Push the GCDQ frames only once, ahead of the first P-frame", False)
+        self.AddParameter("WarmSeeds", "Seed vertices from finished neighbouring pixels, used instead of the default seed, as {pixel: (I3Position, time)}", None)
+        self.AddParameter("BestLLH", "Best 1st pass LLH of this event so far, sent along for early termination", None)
+        self.AddParameter("WarmSeedParticleName", "Name of the output I3Particle for the warm seed", "MillipedeWarmSeedParticle")
         self.AddOutBox("OutBox")
 
     def Configure(self):
         self.GCDQpFrames = self.GetParameter("FramePacket")
         self.nside = self.GetParameter("NSide")
+        self.pixels = self.GetParameter("Pixels")
         self.input_pos_name = self.GetParameter("InputPosName")
         self.input_time_name = self.GetParameter("InputTimeName")
         self.output_particle_name = self.GetParameter("OutputParticleName")
+        self.send_packet_once = self.GetParameter("SendPacketOnce")
+        self.warm_seeds = self.GetParameter("WarmSeeds") or {}
+        self.warm_seed_name = self.GetParameter("WarmSeedParticleName")
+        self.best_llh = self.GetParameter("BestLLH")
 
         p_frame = self.GCDQpFrames[-1]
         if p_frame.Stop != icetray.I3Frame.Stream('P'):
@@ -48,7 +58,11 @@ class SendPixelsToScan(icetray.I3Module):
         self.event_header = p_frame["I3EventHeader"]
         self.event_mjd = get_event_mjd(self.GCDQpFrames)
 
-        self.pixels_to_push = range(healpy.nside2npix(self.nside))
+        self.packet_sent = False
+        if self.pixels is None:
+            self.pixels_to_push = list(range(healpy.nside2npix(self.nside)))
+        else:
+            self.pixels_to_push = [int(p) for p in self.pixels]
         print("Going to submit {} pixels".format(len(self.pixels_to_push)))
 
     def Process(self):
@@ -111,6 +125,15 @@ class SendPixelsToScan(icetray.I3Module):
             particle.energy = energy
             p_frame[self.output_particle_name] = particle
 
+            if pixel in self.warm_seeds:
+                # same direction and position variation, around where the
+                # neighbouring fits converged
+                warm_position, warm_time = self.warm_seeds[pixel]
+                warm_particle = dataclasses.I3Particle(particle)
+                warm_particle.pos = dataclasses.I3Position(warm_position.x + posVariation.x, warm_position.y + posVariation.y, warm_position.z + posVariation.z)
+                warm_particle.time = warm_time
+                p_frame[self.warm_seed_name] = warm_particle
+
             # generate a new event header
             eventHeader = dataclasses.I3EventHeader(self.event_header)
             eventHeader.sub_event_stream = "SCAN_nside%04u_pixel%04u_posvar%04u" % (nside, pixel, i)
@@ -119,9 +142,13 @@ class SendPixelsToScan(icetray.I3Module):
             p_frame["SCAN_HealpixPixel"] = icetray.I3Int(int(pixel))
             p_frame["SCAN_HealpixNSide"] = icetray.I3Int(int(nside))
             p_frame["SCAN_PositionVariationIndex"] = icetray.I3Int(int(i))
+            if self.best_llh is not None:
+                p_frame["SCAN_EventBest1stPassLLH"] = dataclasses.I3Double(float(self.best_llh))
 
-            for frame in self.GCDQpFrames[0:-1]:
-                self.PushFrame(frame)
+            if not self.send_packet_once or not self.packet_sent:
+                for frame in self.GCDQpFrames[0:-1]:
+                    self.PushFrame(frame)
+                self.packet_sent = True
             self.PushFrame(p_frame)
 
 
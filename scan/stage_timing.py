@@ -0,0 +1,108 @@
+from __future__ import print_function
+from __future__ import absolute_import
+
+import time
+import numpy
+
+from icecube import dataclasses
+
+STAGE_TIMES = "SCAN_StageTimes"
+
+# in the order they run for a pixel
+STAGES = ["unpack", "gcd_uncompress", "dom_exclusions", "1st_pass", "2nd_pass", "losses", "write"]
+
+
+def add_stage_time(frame, stage, seconds):
+    """Record the seconds a stage took in the frame's SCAN_StageTimes map"""
+    times = dataclasses.I3MapStringDouble()
+    if STAGE_TIMES in frame:
+        for key, value in frame[STAGE_TIMES].items():
+            times[key] = value
+        frame.Delete(STAGE_TIMES)
+    times[stage] = float(seconds)
+    frame[STAGE_TIMES] = times
+
+
+class StageClock(object):
+    """
+    Times consecutive stages of a tray.
+
+    `start` and `mark` go in the tray as function modules. Frames go
+    through a tray one at a time, so each mark is the time since the last
+    one for that frame.
+    """
+    def __init__(self):
+        self.last = time.time()
+
+    def start(self, frame):
+        self.last = time.time()
+
+    def mark(self, frame, stage):
+        now = time.time()
+        add_stage_time(frame, stage, now-self.last)
+        self.last = now
+
+
+class StageHistograms(object):
+    """Log-binned histograms of the stage times of many pixels"""
+    def __init__(self, low=1e-3, high=1e5, bins_per_decade=4):
+        ndecades = int(round(numpy.log10(high/low)))
+        self.edges = numpy.logspace(numpy.log10(low), numpy.log10(high),
+                                    ndecades*bins_per_decade+1)
+        self.counts = {}
+        self.totals = {}
+
+    def add(self, stage, seconds):
+        if stage not in self.counts:
+            # underflow and overflow bins at the ends
+            self.counts[stage] = numpy.zeros(len(self.edges)+1, dtype=numpy.int64)
+            self.totals[stage] = 0.
+        self.counts[stage][numpy.searchsorted(self.edges, seconds, side='right')] += 1
+        self.totals[stage] += seconds
+
+    def add_frame(self, frame):
+        if STAGE_TIMES not in frame:
+            return
+        for stage, seconds in frame[STAGE_TIMES].items():
+            self.add(stage, seconds)
+
+    def merge(self, other):
+        for stage in other.counts:
+            if stage not in self.counts:
+                self.counts[stage] = numpy.zeros(len(self.edges)+1, dtype=numpy.int64)
+                self.totals[stage] = 0.
+            self.counts[stage] += other.counts[stage]
+            self.totals[stage] += other.totals[stage]
+
+    def quantile(self, stage, q):
+        """Upper bin edge below which a fraction `q` of the times fall"""
+        counts = self.counts[stage]
+        index = numpy.searchsorted(numpy.cumsum(counts), q*counts.sum())
+        if index >= len(self.edges):
+            return numpy.inf
+        return self.edges[index]
+
+    def stages(self):
+        known = [s for s in STAGES if s in self.counts]
+        return known + sorted(s for s in self.counts if s not in STAGES)
+
+    def summary(self):
+        lines = ['{:>15} {:>8} {:>10} {:>10} {:>10} {:>8}'.format(
+                 'stage', 'pixels', 'mean [s]', 'p50 <[s]', 'p90 <[s]', 'share')]
+        total = sum(self.totals.values())
+        for stage in self.stages():
+            n = self.counts[stage].sum()
+            lines.append('{:>15} {:>8d} {:>10.3f} {:>10.3g} {:>10.3g} {:>7.1f}%'.format(
+                         stage, n, self.totals[stage]/n,
+                         self.quantile(stage, 0.5), self.quantile(stage, 0.9),
+                         100.*self.totals[stage]/total if total > 0 else 0.))
+        return '\n'.join(lines)
+
+    def histogram(self, stage):
+        lines = []
+        counts = self.counts[stage]
+        edges = [0.]+list(self.edges)+[numpy.inf]
+        for low, high, n in zip(edges[:-1], edges[1:], counts):
+            if n:
+                lines.append('  {:>10.3g} - {:<10.3g} {}'.format(low, high, n))
+        return '\n'.join(lines)
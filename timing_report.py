@@ -0,0 +1,41 @@
+from __future__ import print_function
+import os
+import sys
+import argparse
+
+from icecube import dataio
+
+sys.path.append('scan')
+from stage_timing import StageHistograms
+
+def main():
+    parser = argparse.ArgumentParser(description='Histogram the per-stage fit times of scanned pixels')
+    parser.add_argument('inputs', nargs='+', help='scan result directories or pixel i3 files')
+    parser.add_argument('--hist', action='store_true', help='also print the histogram of each stage')
+    args = parser.parse_args()
+
+    files = []
+    for path in args.inputs:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                files.extend(os.path.join(root, n) for n in sorted(names)
+                             if n.startswith('pix') and n.endswith('.i3'))
+        else:
+            files.append(path)
+    print('reading {} pixel files'.format(len(files)))
+
+    timing = StageHistograms()
+    for filename in files:
+        for frame in dataio.I3File(filename):
+            timing.add_frame(frame)
+    if not timing.counts:
+        print('no stage times found')
+        return
+    print(timing.summary())
+    if args.hist:
+        for stage in timing.stages():
+            print(stage)
+            print(timing.histogram(stage))
+
+if __name__ == '__main__':
+    main()
@@ -3,44 +3,315 @@ import pickle
 import time
 import argparse
 import threading
+import traceback
 from functools import partial
 import signal
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
 
 import pika
+from icecube import icetray
+
+import envelope
+import compression
+import metrics
 
 
 class DataError(Exception):
     pass
 
+# frame packets shared by many messages are stored once, in a queue named
+# after the packet hash, and expire when nobody has touched them for a day
+PACKET_QUEUE_PREFIX = 'packet-'
+PACKET_EXPIRES = 24*3600*1000
+
+def packet_queue_name(packet_hash):
+    return PACKET_QUEUE_PREFIX+packet_hash
+
+# messages that keep failing end up here, with the traceback attached
+DEAD_LETTER_SUFFIX = '.dead'
+
+def dead_letter_queue_name(queue):
+    return queue+DEAD_LETTER_SUFFIX
+
 class RawQueue(object):
-    def __init__(self, address='localhost', queue='test'):
+    """
+    A queue on the broker. With `exchange`, the queue is bound to that
+    fanout exchange, so it gets a copy of everything published to it.
+    """
+    def __init__(self, address='localhost', queue='test', prefetch=1, exchange=None):
         self.address = address
         self.queue = queue
+        self.prefetch = prefetch
+        self.exchange = exchange
 
     def __enter__(self):
         self.connection = pika.BlockingConnection(pika.ConnectionParameters(self.address))
         self.channel = self.connection.channel()
-        self.channel.queue_declare(queue=self.queue, durable=False)
-        self.channel.basic_qos(prefetch_count=1)
+        self.declare()
+        self.channel.basic_qos(prefetch_count=self.prefetch)
         return self
 
+    def declare(self):
+        self.channel.queue_declare(queue=self.queue, durable=False)
+        if self.exchange:
+            self.channel.exchange_declare(exchange=self.exchange, exchange_type='fanout')
+            self.channel.queue_bind(queue=self.queue, exchange=self.exchange)
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.connection.close()
 
+    def decode_body(self, properties, body):
+        """Undo the compression named in the message properties"""
+        if properties is None:
+            return body
+        try:
+            return compression.decompress(properties.content_encoding, body)
+        except Exception as e:
+            raise DataError('cannot decompress message: {}'.format(e))
+
+    def keepalive(self):
+        """Service heartbeats on a connection that has been sitting idle"""
+        self.connection.process_data_events()
+
+    def declare_packet(self, packet_hash):
+        """Declare the queue holding a frame packet, returning its depth"""
+        ret = self.channel.queue_declare(queue=packet_queue_name(packet_hash),
+                                         durable=False,
+                                         arguments={'x-expires': PACKET_EXPIRES})
+        return ret.method.message_count
+
 class SourceQueue(RawQueue):
+    """
+    Send messages to a queue, or with `exchange` to a fanout exchange
+    where each subscriber binds a queue of its own. `queue` then only
+    names the messages in the metrics.
+    """
+    def __init__(self, address='localhost', queue='test', compression=None, **kwargs):
+        super(SourceQueue, self).__init__(address, queue, **kwargs)
+        self.compression = compression
+
+    def declare(self):
+        if self.exchange:
+            self.channel.exchange_declare(exchange=self.exchange, exchange_type='fanout')
+        else:
+            super(SourceQueue, self).declare()
+
+    def encode_body(self, data):
+        """Compress a message body, returning it with its properties"""
+        body = compression.compress(self.compression, data)
+        properties = pika.BasicProperties(content_encoding=self.compression or 'identity')
+        metrics.MESSAGES.labels(self.queue, 'sent').inc()
+        metrics.BYTES.labels(self.queue, 'sent').inc(len(body))
+        return body, properties
+
     def send(self, data):
-        self.channel.basic_publish(exchange='',
+        body, properties = self.encode_body(data)
+        self.channel.basic_publish(exchange=self.exchange or '',
                                    routing_key=self.queue,
-                                   body=data)
+                                   body=body,
+                                   properties=properties)
+
+    def send_packet(self, packet_hash, data):
+        """Store a frame packet under its hash, unless it is already there"""
+        if self.declare_packet(packet_hash) > 0:
+            return False
+        body, properties = self.encode_body(data)
+        self.channel.basic_publish(exchange='',
+                                   routing_key=packet_queue_name(packet_hash),
+                                   body=body,
+                                   properties=properties)
+        return True
+
+    def flush(self):
+        """Messages known to have failed; plain publishes are never confirmed"""
+        return []
+
+class ConfirmSourceQueue(SourceQueue):
+    """
+    SourceQueue with publisher confirms.
+
+    Messages are pipelined on a second, asynchronous connection, with up to
+    `window` of them waiting for a confirm at once, so sending is not held
+    to one network round trip per message. Messages the broker nacks or
+    returns are collected and handed back by `flush`.
+    """
+    def __init__(self, window=256, *args, **kwargs):
+        super(ConfirmSourceQueue, self).__init__(*args, **kwargs)
+        self.window = window
+        self.slots = threading.BoundedSemaphore(window)
+        self.lock = threading.Lock()
+        self.confirmed = threading.Condition(self.lock)
+        self.outstanding = {} # delivery tag -> body
+        self.failed = []
+        self.packets = {} # delivery tag -> packet queue, for stored packets
+        self.failed_packets = set()
+        self.delivery_tag = 0
+        self.error = None
+        self.ready = threading.Event()
+        self.publish_connection = None
+        self.publish_channel = None
+        self.io_thread = None
+
+    def __enter__(self):
+        super(ConfirmSourceQueue, self).__enter__()
+        self.publish_connection = pika.SelectConnection(pika.ConnectionParameters(self.address),
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_closed,
+            on_close_callback=self._on_connection_closed)
+        self.io_thread = threading.Thread(target=self.publish_connection.ioloop.start)
+        self.io_thread.daemon = True
+        self.io_thread.start()
+        self.ready.wait()
+        if self.error is not None:
+            raise Exception('cannot open publish connection: {}'.format(self.error))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.error is None:
+            self.publish_connection.ioloop.add_callback_threadsafe(self.publish_connection.close)
+        self.io_thread.join()
+        super(ConfirmSourceQueue, self).__exit__(exc_type, exc_val, exc_tb)
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_channel_open(self, channel):
+        self.publish_channel = channel
+        channel.add_on_return_callback(self._on_return)
+        channel.confirm_delivery(ack_nack_callback=self._on_confirm,
+                                 callback=lambda frame: self.ready.set())
+
+    def _on_connection_closed(self, connection, reason):
+        with self.lock:
+            self.error = reason
+            # nothing more will be confirmed
+            for tag in sorted(self.outstanding):
+                self._failed(tag, self.outstanding.pop(tag))
+                self.slots.release()
+            self.confirmed.notify_all()
+        self.ready.set()
+        connection.ioloop.stop()
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        ack = isinstance(method, pika.spec.Basic.Ack)
+        with self.lock:
+            if method.multiple:
+                tags = sorted(t for t in self.outstanding if t <= method.delivery_tag)
+            else:
+                tags = [method.delivery_tag]
+            for tag in tags:
+                if tag not in self.outstanding:
+                    continue
+                body = self.outstanding.pop(tag)
+                if not ack:
+                    self._failed(tag, body)
+                self.packets.pop(tag, None)
+                metrics.MESSAGES.labels(self.queue, 'confirmed' if ack else 'nacked').inc()
+                self.slots.release()
+            metrics.IN_FLIGHT.labels(self.queue).set(len(self.outstanding))
+            self.confirmed.notify_all()
+
+    def _on_return(self, channel, method, properties, body):
+        # unroutable, the confirm that follows is still an ack
+        logging.warning('message returned: %s', method.reply_text)
+        with self.lock:
+            if method.routing_key.startswith(PACKET_QUEUE_PREFIX):
+                self.failed_packets.add(method.routing_key)
+            else:
+                self.failed.append(self.decode_body(properties, body))
+
+    def _failed(self, tag, body):
+        """Note a message that was not confirmed, with the lock held"""
+        if tag in self.packets:
+            self.failed_packets.add(self.packets.pop(tag))
+        else:
+            self.failed.append(body)
+
+    def _publish(self, data, packet_queue=None):
+        body, properties = self.encode_body(data)
+        if packet_queue:
+            exchange, routing_key = '', packet_queue
+        else:
+            exchange, routing_key = self.exchange or '', self.queue
+        self.publish_channel.basic_publish(exchange=exchange,
+                                           routing_key=routing_key,
+                                           body=body,
+                                           properties=properties,
+                                           mandatory=True)
+
+    def send(self, data, packet_queue=None):
+        """
+        Publish without waiting, blocking only while the window is full.
+        Returns the delivery tag.
+        """
+        self.slots.acquire()
+        with self.lock:
+            if self.error is not None:
+                self.slots.release()
+                raise Exception('publish connection closed: {}'.format(self.error))
+            # callbacks run in order, so this is the tag the broker will use
+            self.delivery_tag += 1
+            self.outstanding[self.delivery_tag] = data
+            if packet_queue:
+                self.packets[self.delivery_tag] = packet_queue
+            metrics.IN_FLIGHT.labels(self.queue).set(len(self.outstanding))
+            self.publish_connection.ioloop.add_callback_threadsafe(partial(self._publish, data, packet_queue))
+            return self.delivery_tag
+
+    def send_packet(self, packet_hash, data):
+        """
+        Store a frame packet under its hash, unless it is already there.
+        Every message sent after it may reference it, so wait for its
+        confirm.
+        """
+        if self.declare_packet(packet_hash) > 0:
+            return False
+        packet_queue = packet_queue_name(packet_hash)
+        tag = self.send(data, packet_queue)
+        with self.lock:
+            while tag in self.outstanding and self.error is None:
+                self.confirmed.wait(1)
+            if packet_queue in self.failed_packets:
+                self.failed_packets.discard(packet_queue)
+                raise Exception('frame packet {} was not stored'.format(packet_hash))
+        return True
+
+    def flush(self):
+        """Wait for all outstanding confirms, returning the failed messages"""
+        with self.lock:
+            while self.outstanding and self.error is None:
+                self.confirmed.wait(1)
+            failed, self.failed = self.failed, []
+        return failed
 
 class SinkQueue(RawQueue):
-    def __init__(self, callback=None, timeout=120, *args, **kwargs):
+    """
+    Receive messages from a queue.
+
+    A message whose callback fails is requeued with an `x-retries` header,
+    up to `max_retries` times (forever if None). After that, or straight
+    away for bad data, it goes to the dead-letter queue with the
+    traceback in an `x-error` header.
+    """
+    def __init__(self, callback=None, timeout=120, max_retries=3, *args, **kwargs):
         super(SinkQueue, self).__init__(*args, **kwargs)
         self.callback = callback
         self.timeout = timeout
+        self.max_retries = max_retries
+        self.dead_letter_queue = dead_letter_queue_name(self.queue)
         self.consumer_id = None
         self.running = True
         self.last_time = time.time()
+        self.idle_since = time.time()
+
+    def __enter__(self):
+        super(SinkQueue, self).__enter__()
+        self.channel.queue_declare(queue=self.dead_letter_queue, durable=False)
+        return self
 
     def start_recv(self, callback=None):
         """Blocking recv call"""
@@ -55,6 +326,34 @@ class SinkQueue(RawQueue):
         signal.signal(signal.SIGINT, self.stop)
         self.channel.start_consuming()
 
+    def receive(self, timeout=None):
+        """
+        Blocking pull of one message, left for the caller to ack.
+
+        Returns (delivery_tag, body, properties), or None after `timeout`
+        idle seconds.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        start = time.time()
+        for method, properties, body in self.channel.consume(self.queue,
+                auto_ack=False, inactivity_timeout=timeout):
+            metrics.IDLE.labels(self.queue).inc(time.time()-start)
+            if method is None:
+                return None
+            self.count_received(body)
+            return method.delivery_tag, body, properties
+
+    def get(self, timeout=None):
+        """Blocking pull of one message, returning None after `timeout` idle seconds"""
+        msg = self.receive(timeout)
+        if msg is None:
+            return None
+        delivery_tag, body, properties = msg
+        self.channel.basic_ack(delivery_tag)
+        metrics.MESSAGES.labels(self.queue, 'acked').inc()
+        return self.decode_body(properties, body)
+
     def stop(self, *args, **kwargs):
         self.running = False
         self.connection.add_callback_threadsafe(partial(self.channel.basic_cancel, self.consumer_id))
@@ -64,17 +363,91 @@ class SinkQueue(RawQueue):
             ch.basic_nack(method.delivery_tag)
             raise KeyboardInterrupt()
         self.last_time = time.time()
+        metrics.IDLE.labels(self.queue).inc(self.last_time-self.idle_since)
+        self.count_received(body)
+        try:
+            self.run_callback(method.delivery_tag, body, properties)
+        finally:
+            self.idle_since = time.time()
+
+    def count_received(self, body):
+        metrics.MESSAGES.labels(self.queue, 'received').inc()
+        metrics.BYTES.labels(self.queue, 'received').inc(len(body))
+
+    def run_callback(self, delivery_tag, body, properties=None):
         try:
-            self.callback(body)
+            self.callback(self.decode_body(properties, body))
         except DataError:
-            # bad data in the queue, so ack it to get rid of it
+            # bad data in the queue, so get rid of it
             logging.warning('error with data', exc_info=True)
-            ch.basic_ack(method.delivery_tag)
+            self.dead_letter(delivery_tag, body, properties, traceback.format_exc())
         except Exception:
             logging.warning('error in callback', exc_info=True)
-            ch.basic_nack(method.delivery_tag)
+            self.retry(delivery_tag, body, properties, traceback.format_exc())
         else:
-            ch.basic_ack(method.delivery_tag)
+            self.ack(delivery_tag)
+
+    def ack(self, delivery_tag):
+        metrics.MESSAGES.labels(self.queue, 'acked').inc()
+        self.channel.basic_ack(delivery_tag)
+
+    def nack(self, delivery_tag):
+        metrics.MESSAGES.labels(self.queue, 'nacked').inc()
+        self.channel.basic_nack(delivery_tag)
+
+    def retry(self, delivery_tag, body, properties, error):
+        """Requeue a failed message, counting its retries"""
+        if self.max_retries is None:
+            self.nack(delivery_tag)
+            return
+        headers = dict((properties and properties.headers) or {})
+        retries = headers.get('x-retries', 0)+1
+        if retries > self.max_retries:
+            self.dead_letter(delivery_tag, body, properties, error)
+            return
+        headers['x-retries'] = retries
+        metrics.MESSAGES.labels(self.queue, 'retried').inc()
+        self.republish(delivery_tag, self.queue, body, properties, headers)
+
+    def dead_letter(self, delivery_tag, body, properties, error):
+        """Move a message to the dead-letter queue"""
+        logging.warning('dead-lettering message from %s', self.queue)
+        metrics.MESSAGES.labels(self.queue, 'dead_lettered').inc()
+        headers = dict((properties and properties.headers) or {})
+        headers['x-error'] = error[-10000:]
+        headers['x-original-queue'] = self.queue
+        self.republish(delivery_tag, self.dead_letter_queue, body, properties, headers)
+
+    def republish(self, delivery_tag, routing_key, body, properties, headers):
+        """Publish a copy of a message with new headers, then ack the original"""
+        properties = pika.BasicProperties(
+            content_encoding=properties.content_encoding if properties else None,
+            headers=headers)
+        self.channel.basic_publish(exchange='',
+                                   routing_key=routing_key,
+                                   body=body,
+                                   properties=properties)
+        self.channel.basic_ack(delivery_tag)
+
+    def fetch_packet(self, packet_hash, timeout=60):
+        """
+        Blocking fetch of a stored frame packet.
+
+        The packet message is peeked at and put straight back, so every
+        consumer can read it. Another consumer may be holding it for a
+        moment, so keep trying until `timeout`.
+        """
+        self.declare_packet(packet_hash)
+        end_time = time.time()+timeout
+        while True:
+            method, properties, body = self.channel.basic_get(
+                queue=packet_queue_name(packet_hash), auto_ack=False)
+            if method:
+                self.channel.basic_reject(method.delivery_tag, requeue=True)
+                return self.decode_body(properties, body)
+            if time.time() > end_time:
+                raise Exception('frame packet {} not available'.format(packet_hash))
+            self.connection.sleep(0.1)
 
     def kill(self):
         now = time.time()
@@ -86,49 +459,324 @@ class SinkQueue(RawQueue):
             print('idle timeout hit')
             self.stop()
 
+class AsyncSinkQueue(SinkQueue):
+    """
+    SinkQueue with several messages in flight at once.
+
+    The connection thread only hands messages to a pool of `workers`
+    threads that run the callbacks, so it keeps servicing heartbeats and
+    prefetching up to `prefetch` messages while a long callback runs.
+    Acks and nacks are posted back to the connection thread-safely.
+    """
+    def __init__(self, workers=1, *args, **kwargs):
+        super(AsyncSinkQueue, self).__init__(*args, **kwargs)
+        self.workers = workers
+        self.tasks = Queue.Queue()
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.io_thread = None
+
+    def start_recv(self, callback=None):
+        """Blocking recv call, returning once all workers are done"""
+        self.io_thread = threading.current_thread()
+        threads = []
+        for _ in range(self.workers):
+            t = threading.Thread(target=self.work)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        try:
+            super(AsyncSinkQueue, self).start_recv(callback)
+        finally:
+            self.running = False
+            for t in threads:
+                self.tasks.put(None)
+            # keep the connection going until the last acks are out
+            for t in threads:
+                while t.is_alive():
+                    self.connection.process_data_events(time_limit=1)
+
+    def handle_cb(self, ch, method, properties, body):
+        if not self.running:
+            ch.basic_nack(method.delivery_tag)
+            return
+        with self.lock:
+            if self.in_flight == 0:
+                metrics.IDLE.labels(self.queue).inc(time.time()-self.idle_since)
+            self.in_flight += 1
+            metrics.IN_FLIGHT.labels(self.queue).set(self.in_flight)
+        self.last_time = time.time()
+        self.count_received(body)
+        self.tasks.put((method.delivery_tag, body, properties))
+
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            delivery_tag, body, properties = task
+            try:
+                if self.running:
+                    self.run_callback(delivery_tag, body, properties)
+                else:
+                    # shutting down, so give prefetched messages back
+                    self.nack(delivery_tag)
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+                    metrics.IN_FLIGHT.labels(self.queue).set(self.in_flight)
+                    if self.in_flight == 0:
+                        self.idle_since = time.time()
+                self.last_time = time.time()
+
+    def ack(self, delivery_tag):
+        metrics.MESSAGES.labels(self.queue, 'acked').inc()
+        self.connection.add_callback_threadsafe(partial(self.channel.basic_ack, delivery_tag))
+
+    def nack(self, delivery_tag):
+        metrics.MESSAGES.labels(self.queue, 'nacked').inc()
+        self.connection.add_callback_threadsafe(partial(self.channel.basic_nack, delivery_tag))
+
+    def republish(self, *args):
+        self.connection.add_callback_threadsafe(partial(SinkQueue.republish, self, *args))
+
+    def fetch_packet(self, packet_hash, timeout=60):
+        """Fetch a stored frame packet on the connection thread"""
+        if threading.current_thread() is self.io_thread:
+            return super(AsyncSinkQueue, self).fetch_packet(packet_hash, timeout)
+        ret = {}
+        done = threading.Event()
+        def fetch():
+            try:
+                ret['body'] = SinkQueue.fetch_packet(self, packet_hash, timeout)
+            except Exception as e:
+                ret['error'] = e
+            done.set()
+        self.connection.add_callback_threadsafe(fetch)
+        done.wait()
+        if 'error' in ret:
+            raise ret['error']
+        return ret['body']
+
+    def kill(self):
+        """Idle timeout, which only counts while nothing is in flight"""
+        try:
+            while self.in_flight > 0 or time.time()-self.last_time <= self.timeout:
+                time.sleep(1)
+        finally:
+            print('idle timeout hit')
+            self.stop()
+
 class Source:
     def __init__(self, queue):
         if not isinstance(queue, SourceQueue):
             raise Exception('queue is not a SourceQueue')
         self.queue = queue
 
-    def send(self, frames):
-        data = pickle.dumps({
-            'type': 'data',
-            'frames': frames,
-        })
+    def send(self, frames, packet_hash=None):
+        """
+        Send frames. If `packet_hash` is given, the frames only hold the
+        P-frames and the rest of the packet was stored with `send_packet`.
+        """
+        data = envelope.encode(frames, envelope.TYPE_DATA, packet_hash)
         self.queue.send(data)
 #        print('Sent frame',frames[0].Stop)
         print('Sent frame', frames[-1]['I3EventHeader'].event_id,
               frames[-1]['I3EventHeader'].sub_event_stream)
 
+    def forward(self, frames, packet_hash=None):
+        """
+        Send on frames that came from a Sink. With the `packet_hash` of
+        the stored packet they referenced, only the P-frames go, with the
+        same reference, as the packet is already on the broker.
+        """
+        if packet_hash:
+            frames = [fr for fr in frames if fr.Stop == icetray.I3Frame.Physics]
+        self.send(frames, packet_hash)
+
+    def flush(self, retries=3):
+        """
+        Wait until the queue has confirmed every send, retrying the failed
+        ones. Returns the messages that still failed after `retries`.
+        """
+        failed = self.queue.flush()
+        for i in range(retries):
+            if not failed:
+                break
+            logging.warning('%d sends failed, retry %d', len(failed), i+1)
+            for j, data in enumerate(failed):
+                try:
+                    self.queue.send(data)
+                except Exception:
+                    # the connection is gone, so nothing more will go out
+                    logging.warning('cannot resend', exc_info=True)
+                    return failed[j:]+self.queue.flush()
+            failed = self.queue.flush()
+        return failed
+
+    def send_packet(self, packet_hash, frames):
+        """Store the frame packet shared by many messages, once"""
+        data = envelope.encode(frames, envelope.TYPE_PACKET, packet_hash)
+        if self.queue.send_packet(packet_hash, data):
+            print('Sent packet', packet_hash)
+
 class Sink:
-    def __init__(self, queue, callback):
+    """
+    Receive frames from a SinkQueue.
+
+    `accept` is an optional filter on the message header, called before
+    any frame is deserialized. Messages it rejects are dropped.
+    """
+    def __init__(self, queue, callback, accept=None):
         if not isinstance(queue, SinkQueue):
             raise Exception('queue is not a SinkQueue')
         self.queue = queue
         self.callback = callback
+        self.accept = accept
         self.queue.callback = self.handle_cb
+        self.packets = {}
+        # per thread, callbacks may run on several
+        self.local = threading.local()
 
-    def handle_cb(self, data):
+    def unpack(self, data, accept=None):
+        """
+        Unpack a message into its header and frames, or no frames if
+        `accept` rejects the header.
+        """
         try:
-            data = pickle.loads(data)
-            if data['type'] == 'data':
-                frames = data['frames']
- #               print('Received frame',frames[0].Stop)
-                print('received frames', frames[-1]['I3EventHeader'].event_id,
-                      frames[-1]['I3EventHeader'].sub_event_stream)
+            if envelope.is_envelope(data):
+                header = envelope.decode_header(data)
+                if accept and not accept(header):
+                    return header, None
+                frames = envelope.decode_frames(data, header)
             else:
-                raise DataError('bad data type')
+                # older pickled messages
+                data = pickle.loads(data)
+                msg_type = {'data': envelope.TYPE_DATA,
+                            'packet': envelope.TYPE_PACKET}[data['type']]
+                frames = data['frames']
+                header = envelope.make_header(frames, msg_type, data.get('packet', None))
+                if accept and not accept(header):
+                    return header, None
         except Exception as e:
-            raise DataError(e.message)
-        else:
+            raise DataError(str(e))
+        return header, frames
+
+    def get_packet(self, packet_hash):
+        """Get a stored frame packet, fetching it on first use"""
+        if packet_hash not in self.packets:
+            header, frames = self.unpack(self.queue.fetch_packet(packet_hash))
+            if header.type != envelope.TYPE_PACKET:
+                raise DataError('bad packet type')
+            self.packets[packet_hash] = frames
+            print('received packet', packet_hash)
+        return self.packets[packet_hash]
+
+    def decode(self, data):
+        """Unpack a message into its full list of frames"""
+        start = time.time()
+        try:
+            return self._decode(data)
+        finally:
+            self.local.decode_time = time.time()-start
+
+    def decode_time(self):
+        """Seconds it took to unpack the last message on this thread"""
+        return getattr(self.local, 'decode_time', None)
+
+    def packet_hash(self):
+        """
+        Hash of the stored frame packet the last message on this thread
+        referenced, or None if it carried its packet inline. Frames passed
+        on should reference it too, rather than resending the packet.
+        """
+        return getattr(self.local, 'packet_hash', None)
+
+    def _decode(self, data):
+        self.local.packet_hash = None
+        header, frames = self.unpack(data, self.accept)
+        if header.type != envelope.TYPE_DATA:
+            raise DataError('bad data type')
+        self.local.packet_hash = header.packet_hash
+        if frames is None:
+            print('skipping frames', header.event_id, header.nside, header.pixel, header.posvar)
+            return None
+#        print('Received frame',frames[0].Stop)
+        print('received frames', header.event_id, header.nside, header.pixel, header.posvar)
+        if header.packet_hash:
+            # the cached packet frames are shared by every message
+            frames = self.get_packet(header.packet_hash) + frames
+        return frames
+
+    def handle_cb(self, data):
+        frames = self.decode(data)
+        if frames is not None:
             self.callback(frames)
 
+    def get(self, timeout=None):
+        """Pull the frames of one message, or None after `timeout` idle seconds"""
+        while True:
+            data = self.queue.get(timeout)
+            if data is None:
+                return None
+            frames = self.decode(data)
+            if frames is not None:
+                return frames
+
+
+def redrive(address, queue, limit=None, show=False):
+    """
+    Move dead-lettered messages back to the queue they came from, with a
+    fresh retry count. With `show`, only print why they failed.
+    """
+    count = 0
+    with RawQueue(address, dead_letter_queue_name(queue)) as dead:
+        while limit is None or count < limit:
+            method, properties, body = dead.channel.basic_get(queue=dead.queue, auto_ack=False)
+            if not method:
+                break
+            count += 1
+            headers = dict(properties.headers or {})
+            print('message', count, 'retries', headers.get('x-retries', 0))
+            print(headers.get('x-error', ''))
+            if show:
+                # unacked, so they go back when the connection closes
+                continue
+            target = headers.pop('x-original-queue', queue)
+            headers.pop('x-retries', None)
+            headers.pop('x-error', None)
+            dead.channel.basic_publish(exchange='',
+                                       routing_key=target,
+                                       body=body,
+                                       properties=pika.BasicProperties(
+                                           content_encoding=properties.content_encoding,
+                                           headers=headers))
+            dead.channel.basic_ack(method.delivery_tag)
+    return count
+
+
+def peek_dead_letters(address, queue):
+    """The bodies of the messages dead-lettered from `queue`, left in place"""
+    bodies = []
+    with RawQueue(address, dead_letter_queue_name(queue)) as dead:
+        while True:
+            method, properties, body = dead.channel.basic_get(queue=dead.queue, auto_ack=False)
+            if not method:
+                break
+            try:
+                bodies.append(dead.decode_body(properties, body))
+            except DataError:
+                logging.warning('bad dead-lettered message', exc_info=True)
+    # unacked, so they go back when the connection closes
+    return bodies
+
 
 def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-a', '--address', default='localhost', help='rabbitmq host')
     parser.add_argument('-q', '--queue', default='test', help='queue name')
     parser.add_argument('--timeout', type=int, default=30, help='queue timeout')
+    parser.add_argument('--compression', default=None, choices=compression.available(),
+                        help='compression codec for sent messages')
+    metrics.add_arguments(parser)
     return parser
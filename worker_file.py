@@ -1,42 +1,80 @@
 from __future__ import print_function
-from contextlib import contextmanager
-import pickle
-import base64
 import argparse
-import tempfile
-import shutil
-import subprocess
 import os
+import sys
+import subprocess
+import threading
 import time
-
-import pika
+try:
+    import queue as Queue
+except ImportError:
+    import Queue
 
 from icecube import icetray,dataio,dataclasses
-from I3Tray import I3Tray
 
-from producer import get_parser, get_queue
-from consumer import consumer
+import envelope
+import compression
+from util import SourceQueue, Source, AsyncSinkQueue, Sink
 
 icetray.logging.set_level('WARN')
 
+HELPER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker_file_helper.py')
 
-def process_frames(frames):
-    start = time.time()
-    tmpdir = tempfile.mkdtemp(dir=os.getcwd())
-    out_frames = []
-    try:
-        infilename = os.path.join(tmpdir,'in.i3')
-        outfilename = os.path.join(tmpdir,'out.i3')
-        with dataio.I3File(infilename, 'w') as f:
-            for fr in frames:
-                f.push(fr)
-        subprocess.check_call(['python','worker_file_helper.py',infilename,outfilename])
-        for fr in dataio.I3File(outfilename):
-            out_frames.append(fr)
-    finally:
-        shutil.rmtree(tmpdir)
-    print('time: ',time.time()-start)
-    return out_frames
+
+class HelperPool(object):
+    """
+    Pool of long-lived worker_file_helper.py processes.
+
+    Each helper already has icetray imported and a tray running, and
+    exchanges frames with us over its stdin/stdout pipes. The processing
+    stays out of this process, without a fork, exec or temp file per
+    message. A helper that fails is replaced by a fresh one.
+    """
+    def __init__(self, size=1):
+        self.idle = Queue.Queue()
+        self.helpers = []
+        for _ in range(size):
+            self.idle.put(self.start_helper())
+
+    def start_helper(self):
+        helper = subprocess.Popen([sys.executable, HELPER, '--pipe'],
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.helpers.append(helper)
+        return helper
+
+    def stop_helper(self, helper):
+        self.helpers.remove(helper)
+        try:
+            helper.stdin.close()
+        except Exception:
+            pass
+        if helper.poll() is None:
+            helper.kill()
+        helper.wait()
+
+    def process_frames(self, frames):
+        helper = self.idle.get()
+        try:
+            start = time.time()
+            envelope.write_message(helper.stdin, envelope.encode(frames))
+            data = envelope.read_message(helper.stdout)
+            if data is None:
+                raise Exception('helper exited with code {}'.format(helper.wait()))
+            out_frames = envelope.decode_frames(data)
+            print('time: ',time.time()-start)
+        except Exception:
+            self.stop_helper(helper)
+            helper = self.start_helper()
+            raise
+        finally:
+            self.idle.put(helper)
+        return out_frames
+
+    def close(self):
+        for helper in list(self.helpers):
+            helper.stdin.close()
+            helper.wait()
+            self.helpers.remove(helper)
 
 def main():
     parser = argparse.ArgumentParser()
@@ -44,26 +82,31 @@ def main():
     parser.add_argument('--timeout', type=int, default=10, help='queue timeout')
     parser.add_argument('-i', '--in_queue', help='input queue')
     parser.add_argument('-o', '--out_queue', help='input queue')
+    parser.add_argument('-n', '--num', type=int, default=1, help='number of helper processes')
+    parser.add_argument('--max-retries', dest='max_retries', type=int, default=3,
+                        help='retries for a failing message before it is dead-lettered')
+    parser.add_argument('--compression', default=None, choices=compression.available(),
+                        help='compression codec for sent messages')
     args = parser.parse_args()
 
-    with get_queue(args.address, args.in_queue) as (in_conn, in_channel), get_queue(args.address, args.out_queue) as (out_conn, out_channel):
-        def callback(ch, method, properties, body):
-            data = pickle.loads(body)
-            if data['type'] == 'data':
-                fr_in = data['frames']
-                print('received frame', fr_in[0]['I3EventHeader'].event_id,
-                      fr_in[0]['I3EventHeader'].sub_event_stream)
-                fr_out = process_frames(fr_in)
-                data2 = pickle.dumps({
-                    'type': 'data',
-                    'frames': fr_out,
-                })
-            else:
-                raise Exception('bad type')
-            out_channel.basic_publish(exchange='',
-                                      routing_key=args.out_queue,
-                                      body=data2)
-        consumer(in_conn, in_channel, args.in_queue, callback, timeout=args.timeout)
+    pool = HelperPool(args.num)
+    try:
+        # one callback thread per helper, so all of them stay busy
+        with AsyncSinkQueue(address=args.address, queue=args.in_queue, timeout=args.timeout,
+                            max_retries=args.max_retries,
+                            prefetch=args.num+1, workers=args.num) as in_queue:
+            with SourceQueue(args.address, args.out_queue, compression=args.compression) as out_queue:
+                source = Source(out_queue)
+                lock = threading.Lock()
+                def cb(frames):
+                    packet_hash = sink.packet_hash()
+                    frames2 = pool.process_frames(frames)
+                    with lock:
+                        source.forward(frames2, packet_hash)
+                sink = Sink(in_queue, cb)
+                in_queue.start_recv()
+    finally:
+        pool.close()
 
     print('done!')
 
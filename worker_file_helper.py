@@ -1,18 +1,89 @@
+import os
 import sys
 from icecube import icetray,dataio,dataclasses
 from I3Tray import I3Tray
 
-if len(sys.argv) < 3:
-    raise Exception('must supply at least two filenames as arguments')
+import envelope
+
+class PipeReader(icetray.I3Module):
+    """
+    Driving module that reads messages of frames from a stream.
+
+    Before reading the next message it answers the last one with the
+    frames the PipeWriter collected for it.
+    """
+    def __init__(self, context):
+        icetray.I3Module.__init__(self, context)
+        self.AddParameter('infile', 'input stream', None)
+        self.AddParameter('outfile', 'output stream', None)
+        self.AddParameter('frames', 'output frames collected by the PipeWriter', None)
+        self.in_progress = False
+    def Configure(self):
+        self.infile = self.GetParameter('infile')
+        self.outfile = self.GetParameter('outfile')
+        self.frames = self.GetParameter('frames')
+    def Process(self):
+        self.reply()
+        data = envelope.read_message(self.infile)
+        if data is None:
+            self.RequestSuspension()
+            return
+        self.in_progress = True
+        for fr in envelope.decode_frames(data):
+            self.PushFrame(fr)
+    def Finish(self):
+        self.reply()
+    def reply(self):
+        if self.in_progress:
+            envelope.write_message(self.outfile, envelope.encode(self.frames))
+            del self.frames[:]
+            self.in_progress = False
+
+class PipeWriter(icetray.I3Module):
+    def __init__(self, context):
+        icetray.I3Module.__init__(self, context)
+        self.AddParameter('frames', 'output frames', None)
+        self.AddParameter('streams', 'accepted streams', None)
+    def Configure(self):
+        self.frames = self.GetParameter('frames')
+        self.streams = self.GetParameter('streams')
+    def Process(self):
+        fr = self.PopFrame()
+        if fr.Stop in self.streams:
+            self.frames.append(fr)
+        self.PushFrame(fr)
+
+def test(fr):
+    fr['NewKey'] = dataclasses.I3String('worker key')
 
 icetray.logging.set_level('WARN')
+
+if len(sys.argv) == 2 and sys.argv[1] == '--pipe':
+    # long-lived helper, exchanging messages over stdin/stdout; anything
+    # else printed to stdout goes to stderr so it cannot garble them
+    infile = os.fdopen(os.dup(0), 'rb')
+    outfile = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    frames = []
+    tray = I3Tray()
+    tray.Add(PipeReader, infile=infile, outfile=outfile, frames=frames)
+    tray.Add(test)
+    tray.Add(PipeWriter,
+             streams=[icetray.I3Frame.DAQ, icetray.I3Frame.Physics],
+             frames=frames,
+            )
+    tray.Execute()
+    tray.Finish()
+    sys.exit(0)
+
+if len(sys.argv) < 3:
+    raise Exception('must supply at least two filenames as arguments, or --pipe')
+
 tray = I3Tray()
 tray.Add('I3Reader', filenamelist=sys.argv[1:-1])
-def test(fr):
-    fr['NewKey'] = dataclasses.I3String('worker key')
 tray.Add(test)
 tray.Add('I3Writer',
          streams=[icetray.I3Frame.DAQ, icetray.I3Frame.Physics],
          filename=sys.argv[-1],
         )
-tray.Execute()
\ No newline at end of file
+tray.Execute()
@@ -1,64 +1,125 @@
 from __future__ import print_function
 import argparse
+import logging
 import time
+import traceback
 
 from icecube import icetray,dataio,dataclasses
 from I3Tray import I3Tray
 
-from util import SourceQueue, Source, SinkQueue, Sink, get_parser
+from util import SourceQueue, Source, SinkQueue, Sink, DataError, get_parser
+import compression
+import metrics
 
 icetray.logging.set_level('WARN')
 
-class FrameReader(icetray.I3Module):
+class OutputMessage(object):
+    """
+    The output frames of the message in progress, sent on as one message.
+
+    With a stored packet only the P-frames are kept, as they go on
+    referencing the same packet.
+    """
+    def __init__(self, sender):
+        self.sender = sender
+        self.frames = []
+        self.packet_hash = None
+    def start(self, packet_hash=None):
+        self.frames = []
+        self.packet_hash = packet_hash
+    def add(self, frame):
+        if frame.Stop == icetray.I3Frame.Physics or not self.packet_hash:
+            self.frames.append(frame)
+    def flush(self):
+        frames, self.frames = self.frames, []
+        if any(fr.Stop == icetray.I3Frame.Physics for fr in frames):
+            self.sender(frames, packet_hash=self.packet_hash)
+
+class QueueReader(icetray.I3Module):
+    """
+    Driving module that pulls messages from a SinkQueue as they arrive.
+
+    When the next message is pulled, all the frames of the last one have
+    made it through the tray, so its output is sent on as one message and
+    then it is acked. The message in progress is kept in `pending`, so it
+    can be retried if the tray dies. Stops once the queue has been idle
+    for its timeout.
+    """
     def __init__(self, context):
         icetray.I3Module.__init__(self, context)
-        self.AddParameter('frames', 'input frames', None)
-        self.fr = None
+        self.AddParameter('queue', 'input SinkQueue', None)
+        self.AddParameter('sink', 'Sink to decode the messages', None)
+        self.AddParameter('pending', 'dict holding the message in progress', None)
+        self.AddParameter('output', 'OutputMessage collecting the output of each message', None)
     def Configure(self):
-        frames = self.GetParameter('frames')
-        if not isinstance(frames, list):
-            raise Exception('"frames" should be a list')
-        self.fr = frames
+        self.queue = self.GetParameter('queue')
+        self.sink = self.GetParameter('sink')
+        self.pending = self.GetParameter('pending')
+        if self.pending is None:
+            self.pending = {}
+        self.output = self.GetParameter('output')
     def Process(self):
-        if self.fr:
-            self.PushFrame(self.fr.pop(0))
-        else:
+        self.done()
+        msg = self.queue.receive()
+        if msg is None:
+            print('idle timeout hit')
             self.RequestSuspension()
+            return
+        self.pending['message'] = msg
+        delivery_tag, body, properties = msg
+        try:
+            frames = self.sink.decode(self.queue.decode_body(properties, body))
+        except DataError:
+            logging.warning('error with data', exc_info=True)
+            del self.pending['message']
+            self.queue.dead_letter(delivery_tag, body, properties, traceback.format_exc())
+            return
+        if frames is None:
+            return
+        if self.output:
+            self.output.start(self.sink.packet_hash())
+        for fr in frames:
+            # shallow copy, packets cached by the Sink are shared
+            self.PushFrame(icetray.I3Frame(fr))
+    def Finish(self):
+        self.done()
+    def done(self):
+        """Send the output of the last message, then ack it"""
+        if self.output:
+            self.output.flush()
+        msg = self.pending.pop('message', None)
+        if msg:
+            self.queue.ack(msg[0])
 
-class FrameWriter(icetray.I3Module):
-    def __init__(self, context, streams=None, output=[]):
+class QueueWriter(icetray.I3Module):
+    """Adds every frame to the output of the message in progress"""
+    def __init__(self, context):
         icetray.I3Module.__init__(self, context)
-        self.AddParameter('frames', 'output frames', None)
-        self.AddParameter('streams', 'accepted streams', None)
-        self.streams = None
-        self.fr = None
+        self.AddParameter('output', 'OutputMessage collecting the output of each message', None)
     def Configure(self):
-        frames = self.GetParameter('frames')
-        if not isinstance(frames, list):
-            raise Exception('"frames" should be a list')
-        self.fr = frames
-        self.streams = self.GetParameter('streams')
+        self.output = self.GetParameter('output')
     def Process(self):
         fr = self.PopFrame()
-	self.fr.append(fr)
-        #if self.streams and fr.Stop in self.streams:
-        #    self.fr.append(fr)
+        self.output.add(fr)
+        self.PushFrame(fr)
 
-def process_frames(frames):
-    start = time.time()
+def run_tray(in_queue, sink, source, pending, sleep=0):
+    """Stream messages through one long-lived tray until the queue is idle"""
+    # one output message per input message, so batches stay batched
+    output = OutputMessage(source.send)
     tray = I3Tray()
-    tray.Add(FrameReader, frames=frames)
+    tray.Add(QueueReader, queue=in_queue, sink=sink, pending=pending, output=output)
     def test(fr):
         fr['NewKey'] = dataclasses.I3String('worker key')
     tray.Add(test)
-    out_frames = []
-    tray.Add(FrameWriter,
-             streams=[icetray.I3Frame.DAQ, icetray.I3Frame.Physics],
-             frames=out_frames,
-            )
+    if sleep:
+        def delay(fr):
+            time.sleep(sleep)
+        tray.Add(delay, Streams=[icetray.I3Frame.Physics])
+    tray.Add(QueueWriter, output=output)
     tray.Execute()
-    print('time: ',time.time()-start)
-    return out_frames
+    tray.Finish()
+    del tray
 
 def main():
     parser = argparse.ArgumentParser()
@@ -67,18 +128,32 @@ def main():
     parser.add_argument('-i', '--in_queue', help='input queue')
     parser.add_argument('-o', '--out_queue', help='input queue')
     parser.add_argument('--sleep', default=0, type=int, help='sleep delay when processing work')
+    parser.add_argument('--max-retries', dest='max_retries', type=int, default=3,
+                        help='retries for a failing message before it is dead-lettered')
+    parser.add_argument('--compression', default=None, choices=compression.available(),
+                        help='compression codec for sent messages')
+    metrics.add_arguments(parser)
     args = parser.parse_args()
+    metrics.setup(args, 'worker')
 
-    with SinkQueue(address=args.address, queue=args.in_queue, timeout=args.timeout) as in_queue:
-        with SourceQueue(args.address, args.out_queue) as out_queue:
+    with SinkQueue(address=args.address, queue=args.in_queue, timeout=args.timeout,
+                   max_retries=args.max_retries) as in_queue:
+        with SourceQueue(args.address, args.out_queue, compression=args.compression) as out_queue:
             source = Source(out_queue)
-            def cb(frames):
-                frames2 = process_frames(frames)
-                if args.sleep:
-                    time.sleep(args.sleep)
-                source.send(frames2)
-            sink = Sink(in_queue, cb)
-            in_queue.start_recv()
+            sink = Sink(in_queue, None)
+            pending = {}
+            while True:
+                try:
+                    run_tray(in_queue, sink, source, pending, sleep=args.sleep)
+                except Exception:
+                    # the tray died on a message, so retry that one and
+                    # start a fresh tray
+                    logging.warning('error in tray', exc_info=True)
+                    msg = pending.pop('message', None)
+                    if msg:
+                        in_queue.retry(msg[0], msg[1], msg[2], traceback.format_exc())
+                else:
+                    break
 
     print('done!')
 